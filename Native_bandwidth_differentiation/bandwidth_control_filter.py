@@ -1,14 +1,12 @@
 from threading import Thread
-from eventlet import Timeout
-from swift.common.request_helpers import SegmentedIterable
 from swift.common.utils import get_logger
 from swift.common.swob import wsgify
 from swift.common.utils import register_swift_info
-from threading import Lock
-import select
-import Queue
+from threading import Lock, Condition, Event
+from collections import deque
+import itertools
+import heapq
 import time
-import pika
 import os
 import redis
 import socket
@@ -16,10 +14,36 @@ import socket
 
 CHUNK_SIZE = 65536
 MB = 1024*1024.
-# Check and control the data flow every interval
-SLEEP_CALCULATION_INTERVAL = 0.5
+# Bytes (in MB) that a bandwidth class can send at once after being idle
+DEFAULT_BW_BURST = CHUNK_SIZE / MB
 # Maximum throughput of a single node in the system (Gb Ethernet = 110MB (APPROX))
 BW_MAX = 100
+# Bandwidth (MB/s) assured to projects without an SLO, they borrow the rest
+DEFAULT_PROJECT_BW = 1
+# Bytes a stream of weight 1 can send in each round of its bandwidth class
+STREAM_QUANTUM = CHUNK_SIZE
+# Highest weight a request can ask for with the X-Bandwidth-Weight header
+MAX_STREAM_WEIGHT = 16
+# Threads moving the data of all the bandwidth classes
+DEFAULT_SCHEDULER_WORKERS = 4
+# Seconds without streams after which a bandwidth class is discarded
+CLASS_IDLE_TIMEOUT = 10
+# Sources of bandwidth limit updates, in the limit_sources option
+available_limit_sources = {"RABBIT", "REDIS", "FILE"}
+DEFAULT_LIMIT_SOURCES = "RABBIT"
+DEFAULT_RABBIT_HOST = 'controller'
+DEFAULT_RABBIT_PORT = 5672
+DEFAULT_RABBIT_USER = 'openstack'
+DEFAULT_RABBIT_PASS = 'openstack'
+DEFAULT_LIMIT_CHANNEL = 'SLO:bandwidth:updates'
+DEFAULT_LIMIT_FILE = '/etc/swift/bandwidth_limits'
+# Seconds between checks of the limits file
+LIMIT_FILE_POLL_INTERVAL = 1
+# Limit updates received within this interval are applied together
+LIMIT_BATCH_INTERVAL = 0.1
+# First and maximum seconds to wait before reconnecting a limit source
+LIMIT_SOURCE_RETRY_MIN = 1
+LIMIT_SOURCE_RETRY_MAX = 60
 
 
 class Singleton(type):
@@ -54,16 +78,31 @@ class BandwidthControlFilter(object):
 
         self.redis = redis.StrictRedis(redis_host, redis_port, redis_db)
 
-        self.get_bw_control = {}
-        self.put_bw_control = {}
+        # Bandwidth classes, keyed by (project, storage policy, direction)
+        self.bw_classes = {}
+        self.bw_classes_lock = Lock()
+        self.scheduler = BandwidthScheduler(self.logger, self._get_scheduler_workers())
+        self.bw_burst = self._get_bw_burst()
 
-        self._start_assignments_consumer()
+        # Limits hierarchy of each direction: node -> storage policy -> project -> request
+        self.node_bw = self._get_bw_param('node_bw', BW_MAX)
+        self.htb_roots = dict((method, HTBNode('node-'+method, self.node_bw, self.node_bw, self.bw_burst))
+                              for method in ('get', 'put'))
+        self.policy_nodes = {}
+        self.request_bw = self._get_bw_param('request_bw', 0)
+
+        # Limits received from the limit sources, they outlive the bandwidth classes
+        self.bw_limits = {}
+        # Started on the first request, so that no broker delays the proxy start
+        self.limit_updater = LimitUpdater(self.logger, self._create_limit_sources(), self._apply_bw_limits)
 
     def register_info(self):
         register_swift_info('bandwidth_control_filter')
 
     @wsgify
     def __call__(self, req):
+        self.limit_updater.start()
+
         if req.method == 'GET':
             response = req.get_response(self.app)
 
@@ -83,6 +122,30 @@ class BandwidthControlFilter(object):
         else:
             return req.get_response(self.app)
 
+    def _get_scheduler_workers(self):
+        if self.parameters and 'scheduler_workers' in self.parameters:
+            return int(self.parameters['scheduler_workers'])
+        return DEFAULT_SCHEDULER_WORKERS
+
+    def _get_param(self, name, default):
+        if self.parameters and name in self.parameters:
+            return self.parameters[name]
+        return default
+
+    def _get_bw_param(self, name, default):
+        return float(self._get_param(name, default))
+
+    def _get_redis_bw(self, key, default):
+        redis_bw = self.redis.get(key)
+        if redis_bw is not None:
+            return float(redis_bw)
+        return default
+
+    def _get_bw_burst(self):
+        if self.parameters and 'bw_burst' in self.parameters:
+            return float(self.parameters['bw_burst'])
+        return DEFAULT_BW_BURST
+
     def _get_project_id(self, req_resp):
         """
         This method returns the current project ID
@@ -103,119 +166,137 @@ class BandwidthControlFilter(object):
 
         return storage_policy
 
-    def _put_object(self, request, data_iter):
-        r, w = os.pipe()
-        write_pipe = os.fdopen(w, 'w')
-
-        read_pipe = data_iter
+    def _get_stream_weight(self, req_resp):
+        """
+        Share of its bandwidth class that a request asks for. It only
+        competes with the other requests of the same project.
+        """
+        try:
+            weight = int(req_resp.environ.get('HTTP_X_BANDWIDTH_WEIGHT', 1))
+        except ValueError:
+            weight = 1
+        return min(max(weight, 1), MAX_STREAM_WEIGHT)
 
+    def _put_object(self, request, data_iter):
         project = self._get_project_id(request)
         storage_policy = self._get_storage_policy_id(request)
 
-        thd_id = project+"-"+storage_policy
-
-        if thd_id in self.put_bw_control and self.put_bw_control[thd_id].alive:
-            thr = self.put_bw_control[thd_id]
-        else:
-            if thd_id in self.put_bw_control:
-                del self.put_bw_control[thd_id]
-            self.logger.info("Bandwidth Differentiation - Creating new "
-                             "PUT thread: "+project+":"+storage_policy)
-
-            redis_bw = self.redis.get('SLO:bandwidth:put_bw:'+project+'#'+storage_policy)
-            if redis_bw is not None:
-                initial_bw = int(redis_bw)
-            else:
-                initial_bw = BW_MAX
-
-            thr = BandwidthThreadControl(thd_id, self.logger, initial_bw)
-            self.put_bw_control[thd_id] = thr
-            thr.daemon = True
-            thr.start()
-
-        thr.add_stream(write_pipe, read_pipe)
-        self.logger.info("Bandwidth Differentiation - Added PUT stream to control thread: "+thd_id)
-        return DataFdIter(r, 10)
+        bw_class = self._get_bw_class(project, storage_policy, 'put')
+        throttled_iter = ThrottledIter(data_iter, bw_class, self._get_stream_weight(request),
+                                       self._get_request_bucket())
+        self.logger.info("Bandwidth Differentiation - Added PUT stream to bandwidth class: "+bw_class.class_id)
+        return throttled_iter
 
     def _get_object(self, response, data_iter):
-        r, w = os.pipe()
-        write_pipe = os.fdopen(w, 'w')
-
-        if self.server == 'object':
-            read_pipe = data_iter._fp
-        else:
-            read_pipe = data_iter
-            if isinstance(read_pipe, SegmentedIterable):
-                read_pipe = read_pipe.app_iter
-
         project = self._get_project_id(response)
         storage_policy = self._get_storage_policy_id(response)
 
-        thd_id = project+"-"+storage_policy
+        bw_class = self._get_bw_class(project, storage_policy, 'get')
+        throttled_iter = ThrottledIter(data_iter, bw_class, self._get_stream_weight(response),
+                                       self._get_request_bucket())
+        self.logger.info("Bandwidth Differentiation - Added GET stream to bandwidth class: "+bw_class.class_id)
+        return throttled_iter
 
-        if thd_id in self.get_bw_control and self.get_bw_control[thd_id].alive:
-            thr = self.get_bw_control[thd_id]
-        else:
-            if thd_id in self.get_bw_control:
-                del self.get_bw_control[thd_id]
-            self.logger.info("Bandwidth Differentiation - Creating new "
-                             "GET thread: "+project+":"+storage_policy)
-
-            redis_bw = self.redis.get('SLO:bandwidth:get_bw:'+project+'#'+storage_policy)
-            if redis_bw is not None:
-                initial_bw = int(redis_bw)
+    def _get_request_bucket(self):
+        # Cap of every single request, if request_bw is set
+        if self.request_bw:
+            return TokenBucket(self.request_bw * MB, self.bw_burst * MB)
+        return None
+
+    def _read_policy_bw(self, storage_policy, method):
+        """
+        Storage policies get their policy_bw/policy_bw_ceil params, unless
+        SLO:bandwidth:<method>_policy_bw[_ceil]:<policy> are set in Redis.
+        """
+        rate = self._get_redis_bw('SLO:bandwidth:'+method+'_policy_bw:'+storage_policy,
+                                  self._get_bw_param('policy_bw', self.node_bw))
+        ceil = self._get_redis_bw('SLO:bandwidth:'+method+'_policy_bw_ceil:'+storage_policy,
+                                  self._get_bw_param('policy_bw_ceil', self.node_bw))
+        return rate, ceil
+
+    def _get_policy_node(self, storage_policy, method, policy_bw):
+        key = (storage_policy, method)
+        if key not in self.policy_nodes:
+            rate, ceil = policy_bw
+            self.policy_nodes[key] = HTBNode('policy-'+storage_policy+'-'+method, rate, ceil,
+                                             self.bw_burst, self.htb_roots[method])
+        return self.policy_nodes[key]
+
+    def _get_bw_class(self, project, storage_policy, method):
+        """
+        Projects are assured the bandwidth of their SLO, or project_bw, and
+        borrow the unused bandwidth of their storage policy up to their
+        ceil, SLO:bandwidth:<method>_bw_ceil:<project>#<policy> or
+        project_bw_ceil.
+        """
+        key = (project, storage_policy, method)
+        bw_class = self.bw_classes.get(key)
+        if bw_class is not None and not bw_class.expired():
+            return bw_class
+
+        # Redis is read before taking the lock, so that it only delays this request
+        policy_bw = None
+        if (storage_policy, method) not in self.policy_nodes:
+            policy_bw = self._read_policy_bw(storage_policy, method)
+        redis_bw = redis_ceil = None
+        if key not in self.bw_limits:
+            redis_bw = self._get_redis_bw('SLO:bandwidth:'+method+'_bw:'+project+'#'+storage_policy, None)
+            redis_ceil = self._get_redis_bw('SLO:bandwidth:'+method+'_bw_ceil:'+project+'#'+storage_policy, None)
+
+        with self.bw_classes_lock:
+            bw_class = self.bw_classes.get(key)
+            if bw_class is None or bw_class.expired():
+                self.logger.info("Bandwidth Differentiation - Creating new " +
+                                 method.upper()+" bandwidth class: "+project+":"+storage_policy)
+
+                policy_node = self._get_policy_node(storage_policy, method, policy_bw)
+                if key in self.bw_limits:
+                    initial_bw, ceil_bw = self.bw_limits[key]
+                else:
+                    initial_bw = redis_bw if redis_bw is not None else \
+                        self._get_bw_param('project_bw', DEFAULT_PROJECT_BW)
+                    ceil_bw = redis_ceil if redis_ceil is not None else \
+                        self._get_bw_param('project_bw_ceil', policy_node.ceil)
+
+                node = HTBNode(project+"-"+storage_policy+"-"+method, initial_bw, ceil_bw,
+                               self.bw_burst, policy_node)
+                bw_class = BandwidthClass(node.name, self.logger, node, self.scheduler)
+                self.bw_classes[key] = bw_class
+        return bw_class
+
+    def _create_limit_sources(self):
+        sources = []
+        for name in self._get_param('limit_sources', DEFAULT_LIMIT_SOURCES).split(','):
+            name = name.strip().upper()
+            if not name:
+                continue
+            if name not in available_limit_sources:
+                raise Exception("Unsupported bandwidth limit source: " + name)
+            if name == 'RABBIT':
+                sources.append(RabbitLimitSource(self._get_param('rabbit_host', DEFAULT_RABBIT_HOST),
+                                                 int(self._get_param('rabbit_port', DEFAULT_RABBIT_PORT)),
+                                                 self._get_param('rabbit_user', DEFAULT_RABBIT_USER),
+                                                 self._get_param('rabbit_pass', DEFAULT_RABBIT_PASS),
+                                                 socket.gethostname()))
+            elif name == 'REDIS':
+                sources.append(RedisLimitSource(self.redis,
+                                                self._get_param('limit_channel', DEFAULT_LIMIT_CHANNEL)))
             else:
-                initial_bw = BW_MAX
-
-            thr = BandwidthThreadControl(thd_id, self.logger, initial_bw)
-            self.get_bw_control[thd_id] = thr
-            thr.daemon = True
-            thr.start()
-
-        thr.add_stream(write_pipe, read_pipe)
-        self.logger.info("Bandwidth Differentiation - Added GET stream to control thread: "+thd_id)
-        return DataFdIter(r, 10)
-
-    def _start_assignments_consumer(self):
-        self.logger.info("Bandwidth Differentiation - Starting bandwidth "
-                         "assignments consumer")
-
-        rabbit_host = 'controller'
-        rabbit_port = 5672
-        rabbit_user = 'openstack'
-        rabbit_pass = 'openstack'
-        exchange = 'amq.topic'
-
-        host_name = socket.gethostname()
-        routing_key = host_name
-        queue_bw = "bandwidth_assignations:"+host_name
-
-        credentials = pika.PlainCredentials(rabbit_user, rabbit_pass)
-        parameters = pika.ConnectionParameters(host=rabbit_host,
-                                               port=rabbit_port,
-                                               credentials=credentials)
-        self.connection = pika.BlockingConnection(parameters)
-        channel = self.connection.channel()
-        channel.queue_declare(queue=queue_bw)
-        channel.queue_bind(exchange=exchange, routing_key=routing_key, queue=queue_bw)
-        channel.basic_consume(self._bw_assignations, queue=queue_bw, no_ack=True)
-
-        thbw_assignation = Thread(target=channel.start_consuming)
-        thbw_assignation.start()
-
-    def _bw_assignations(self, ch, m, properties, body):
-        project, method, storage_policy, bw = body.split('/')
-        thread_key = project+":"+storage_policy
-        if method == "get":
-            try:
-                self.get_bw_control[thread_key].update_bw_limit(float(bw))
-            except KeyError:
-                pass
-        elif method == "put":
-            try:
-                self.put_bw_control[thread_key].update_bw_limit(float(bw))
-            except KeyError:
-                pass
+                sources.append(FileLimitSource(self._get_param('limit_file', DEFAULT_LIMIT_FILE)))
+        return sources
+
+    def _apply_bw_limits(self, limits):
+        """
+        Applies a batch of {(project, storage policy, method): (bw, ceil)}
+        limits at once, to the live bandwidth classes and to the ones to come.
+        """
+        with self.bw_classes_lock:
+            self.bw_limits.update(limits)
+            for key, (bw, ceil) in limits.items():
+                if key in self.bw_classes:
+                    self.bw_classes[key].update_bw_limit(bw, ceil)
+        self.logger.info("Bandwidth Differentiation - Applied " + str(len(limits)) +
+                         " bandwidth limit updates")
 
 
 def filter_factory(global_conf, **local_conf):
@@ -227,241 +308,488 @@ def filter_factory(global_conf, **local_conf):
     return bandwidth_control_filter
 
 
-class BandwidthThreadControl(Thread):
+class LimitUpdater(object):
+    """
+    Collects the bandwidth limits published by the limit sources and
+    applies them in batches. Every source runs in its own thread and
+    reconnects on failure, without ever blocking the requests.
+    """
+
+    def __init__(self, logger, sources, on_update, batch_interval=LIMIT_BATCH_INTERVAL):
+        self.logger = logger
+        self.sources = sources
+        self.on_update = on_update
+        self.batch_interval = batch_interval
+        self.pending = {}
+        self.lock = Lock()
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for source in self.sources:
+            consumer = Thread(target=self._consume, args=(source,))
+            consumer.daemon = True
+            consumer.start()
+        applier = Thread(target=self.run)
+        applier.daemon = True
+        applier.start()
+
+    def _consume(self, source):
+        retry = LIMIT_SOURCE_RETRY_MIN
+        while True:
+            try:
+                source.consume(self.receive)
+                retry = LIMIT_SOURCE_RETRY_MIN
+            except Exception as e:
+                self.logger.error("Bandwidth Differentiation - Limit source " + type(source).__name__ +
+                                  " failed, retrying in " + str(retry) + "s: " + str(e))
+                time.sleep(retry)
+                retry = min(retry * 2, LIMIT_SOURCE_RETRY_MAX)
+
+    def receive(self, body):
+        """
+        body holds one project/method/storage_policy/bw[/ceil] limit per
+        line. Without a ceil, bw is a hard limit, as assigned by the
+        controller; with it, the project can borrow up to the ceil.
+        """
+        limits = {}
+        for line in body.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                fields = line.split('/')
+                if len(fields) not in (4, 5):
+                    raise ValueError(line)
+                project, method, storage_policy, bw = fields[:4]
+                ceil = float(fields[4]) if len(fields) == 5 else float(bw)
+                limits[(project, storage_policy, method)] = (float(bw), ceil)
+            except ValueError:
+                self.logger.warning("Bandwidth Differentiation - Malformed bandwidth limit: " + line)
+        with self.lock:
+            self.pending.update(limits)
 
-    def __init__(self, thd_id, log, initial_bw):
-        Thread.__init__(self)
-        self.thd_id = thd_id
+    def run(self):
+        while True:
+            time.sleep(self.batch_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            limits = self.pending
+            self.pending = {}
+        if limits:
+            try:
+                self.on_update(limits)
+            except Exception as e:
+                self.logger.error("Bandwidth Differentiation - Unable to apply bandwidth limits: " + str(e))
+
+
+class RabbitLimitSource(object):
+    """
+    Limits sent by the controller through RabbitMQ, routed by host name.
+    Every proxy worker consumes from its own exclusive queue, so that all
+    of them get every update.
+    """
+
+    def __init__(self, host, port, user, password, routing_key, exchange='amq.topic'):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.routing_key = routing_key
+        self.exchange = exchange
+
+    def consume(self, callback):
+        import pika
+        credentials = pika.PlainCredentials(self.user, self.password)
+        parameters = pika.ConnectionParameters(host=self.host, port=self.port, credentials=credentials)
+        connection = pika.BlockingConnection(parameters)
+        try:
+            channel = connection.channel()
+            queue = channel.queue_declare(exclusive=True).method.queue
+            channel.queue_bind(exchange=self.exchange, routing_key=self.routing_key, queue=queue)
+            channel.basic_consume(lambda ch, method, properties, body: callback(body),
+                                  queue=queue, no_ack=True)
+            channel.start_consuming()
+        finally:
+            if connection.is_open:
+                connection.close()
+
+
+class RedisLimitSource(object):
+    """
+    Limits published to a Redis pub/sub channel.
+    """
+
+    def __init__(self, redis_client, channel):
+        self.redis = redis_client
+        self.channel = channel
+
+    def consume(self, callback):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    callback(message['data'])
+        finally:
+            pubsub.close()
+        raise Exception("Redis subscription to " + self.channel + " closed")
+
+
+class FileLimitSource(object):
+    """
+    Limits kept in a local file, reloaded whenever it changes. It still
+    applies limits while the controller or the brokers are unreachable.
+    """
+
+    def __init__(self, path, poll_interval=LIMIT_FILE_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.mtime = None
+
+    def consume(self, callback):
+        while True:
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != self.mtime:
+                with open(self.path) as limits_file:
+                    callback(limits_file.read())
+                self.mtime = mtime
+            time.sleep(self.poll_interval)
+
+
+class BandwidthScheduler(object):
+    """
+    Moves the data of every bandwidth class with a fixed pool of worker
+    threads. Classes with streams wait in a heap ordered by the instant at
+    which they can transfer their next chunk, so the number of threads does
+    not depend on the number of projects and storage policies.
+    """
+
+    def __init__(self, logger, workers):
+        self.logger = logger
+        # (instant, sequence, bandwidth class) of the classes with streams
+        self.ready = []
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.workers = []
+        for _ in range(workers):
+            worker = Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def schedule(self, bw_class, instant):
+        with self.condition:
+            heapq.heappush(self.ready, (instant, next(self.sequence), bw_class))
+            self.condition.notify()
+
+    def _next_class(self):
+        with self.condition:
+            while True:
+                if not self.ready:
+                    self.condition.wait()
+                    continue
+                delay = self.ready[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self.ready)[2]
+                self.condition.wait(delay)
+
+    def _run(self):
+        while True:
+            bw_class = self._next_class()
+            try:
+                instant = bw_class.serve()
+            except Exception as e:
+                self.logger.error("Bandwidth Differentiation - Error serving " +
+                                  bw_class.class_id + ": " + str(e))
+                instant = bw_class.reschedule_instant()
+            if instant is not None:
+                self.schedule(bw_class, instant)
+
+
+class BandwidthClass(object):
+    """
+    Streams of a project and storage policy in one direction, sharing
+    the same bandwidth limit. The class is in the scheduler at most once,
+    so only one worker serves it at a time.
+    """
+
+    def __init__(self, class_id, log, node, scheduler):
+        self.class_id = class_id
         self.logger = log
+        self.scheduler = scheduler
 
-        # Last instant at which a bw calculation has been done
-        self.streams = Queue.Queue()
-
-        # Timeout for reading stream from the streams queue
-        self.timeout = 10
-
-        # This sleep value changes depending on the bw rate configured
-        self.dynamic_sleep = 0.0
-
-        # Bytes transferred in the present bw control interval
-        self.transferred_bytes_control = 0
-
-        # Number of data flow iterations within control interval
-        self.number_of_iterations = 0
+        # Streams in deficit round robin order, the head has the turn
+        self.streams = deque()
+        self.streams_lock = Lock()
+        # Whether the class is waiting in the scheduler or being served
+        self.scheduled = False
+        self.idle_since = time.time()
 
-        # Bandwidth limit
-        self.bandwidth_limit = initial_bw
+        # Bandwidth limits, shared with the parent storage policy and node
+        self.node = node
 
-        # To stop useless threads
-        self.alive = True
+    @property
+    def bandwidth_limit(self):
+        return self.node.rate
 
-        # Calculate initial sleep
-        self._calculate_initial_sleep()
+    def add_stream(self, stream):
+        with self.streams_lock:
+            self.streams.append(stream)
 
-        # Control periodically the enforcement of bw limits
-        self.rate_control = Thread(target=self._rate_control)
-        self.rate_control.daemon = True
-        self.rate_control.start()
-
-    def add_stream(self, write_pipe, read_pipe):
-        pipe_tuple = (write_pipe, read_pipe)
-        self.streams.put(pipe_tuple)
+    def remove_stream(self, stream):
+        with self.streams_lock:
+            try:
+                self.streams.remove(stream)
+            except ValueError:
+                pass
+            if not self.streams:
+                self.idle_since = time.time()
 
-    def update_bw_limit(self, limit):
+    def acquire(self, stream, size):
+        """
+        Blocks until the stream is allowed to move size bytes.
+        """
+        with self.streams_lock:
+            stream.request(size)
+            schedule = not self.scheduled
+            self.scheduled = True
+        if schedule:
+            self.scheduler.schedule(self, time.time())
+        stream.wait()
+
+    def expired(self):
+        with self.streams_lock:
+            return not self.streams and not self.scheduled and \
+                time.time() - self.idle_since > CLASS_IDLE_TIMEOUT
+
+    def update_bw_limit(self, limit, ceil=None):
         if limit == 0.0:
             limit = 1.0
 
-        self.bandwidth_limit = limit
-        self._calculate_initial_sleep()
+        self.node.update(rate=limit, ceil=ceil)
 
-    def _calculate_initial_sleep(self):
+    def reschedule_instant(self):
         """
-        This method calculates the initial sleep based on some magic numbers.
-         ** EXPERIMENTAL **
+        Instant of the next grant, or None if no stream is waiting and the
+        class leaves the scheduler until one asks again.
         """
-        BEST_CHUNK_READ_TIME = 0.0002
-
-        self.max_iterations = int(round(((self.bandwidth_limit * SLEEP_CALCULATION_INTERVAL) * MB) / CHUNK_SIZE))
-        read_chunk = BEST_CHUNK_READ_TIME * self.max_iterations
-        self.calc_sleep = ((SLEEP_CALCULATION_INTERVAL - read_chunk) / self.max_iterations)
-
-        self.dynamic_sleep_mean = self.calc_sleep
-        self.dynamic_sleep = self.calc_sleep
-        self.total_sleep_mean = self.calc_sleep
-        self.iters_mean = 1
-        self.counter = 0
-        self.bad_counter = 0
-
-    def _rate_control(self):
-        while self.alive:
-            time.sleep(SLEEP_CALCULATION_INTERVAL)
-            # Copy required counters
-            trabsferred_bytes = self.transferred_bytes_control
-            iterations = self.number_of_iterations
-
-            # Reset counters for new interval calculation
-            self.transferred_bytes_control = 0
-            self.number_of_iterations = 0
-
-            # Estimate the current transfer bw
-            mb = float(trabsferred_bytes/MB)
-            bandwidth_estimation = round(mb/SLEEP_CALCULATION_INTERVAL, 2)
-
-            # Calculate the deviation in percentage
-            slo_deviation = bandwidth_estimation - self.bandwidth_limit
-            slo_deviation_percentage = (slo_deviation*100)/self.bandwidth_limit
-            # Apply the calculated percentage in the current dynamic_sleep
-            sleep_deviation = (self.dynamic_sleep*slo_deviation_percentage)/100
-
-            # Add the sleep_deviation to calculate the new dynamic_sleep
-            new_dynamic_sleep = self.dynamic_sleep + sleep_deviation
-
-            previous_dynamic_sleep = self.dynamic_sleep
-
-            if slo_deviation < 1.5:
-                self.iters_mean += 1
-                self.total_sleep_mean += new_dynamic_sleep
-                self.dynamic_sleep_mean = self.total_sleep_mean/self.iters_mean
-
-            sleep_ratio = new_dynamic_sleep/self.dynamic_sleep_mean
-
-            if sleep_ratio < 1.2 and sleep_ratio > 0.7:
-                self.counter += 1
-                self.bad_counter = 0
-                self.dynamic_sleep = abs(new_dynamic_sleep)
-            else:
-                self.counter = 0
-                self.bad_counter += 1
-
-                if self.bad_counter > 10:
-                    self.dynamic_sleep = new_dynamic_sleep
-                    self.bad_counter = 0
-                else:
-                    self.dynamic_sleep = self.dynamic_sleep_mean
-
-            f = open("/tmp/bw_control_"+self.thd_id+".dat", 'a+')
-            f.write("\n##############################\n")
-            f.write("Required Bandwidth : "+str(self.bandwidth_limit)+"\n")
-            f.write("Current Bandwidth  : "+str(bandwidth_estimation)+"\n")
-            f.write("-----\n")
-            f.write("Required Iterations : "+str(self.max_iterations)+"\n")
-            f.write("Current Iterations  : "+str(iterations)+"\n")
-            f.write("-----\n")
-            f.write("Prev. dynamic sleep: "+'{0:.6f}'.format(round(previous_dynamic_sleep, 6))+"\n")
-            f.write("New dynamic sleep  : "+'{0:.6f}'.format(round(new_dynamic_sleep, 6))+"\n")
-            f.write("-----\n")
-            f.write("Mean sleep  : "+'{0:.6f}'.format(round(self.dynamic_sleep_mean, 6))+"\n")
-            f.write("Calc. sleep : "+'{0:.6f}'.format(round(self.calc_sleep, 6))+"\n")
-            f.write("-----\n")
-            f.write("In Range sleep     : "+str(self.counter)+"\n")
-            f.write("Not in range sleep : "+str(self.bad_counter)+"\n")
-            f.close()
-
-    def _read_chunk(self, reader):
-        try:
-            if hasattr(reader, 'read'):
-                chunk = reader.read(CHUNK_SIZE)
-            else:
-                chunk = reader.next()
-            return chunk
-        except StopIteration:
-            return False
-
-    def _write_with_timeout(self, writer, chunk):
-        try:
-            with Timeout(self.timeout):
-                writer.write(chunk)
-        except Timeout:
-            writer.close()
-            raise
-
-    def run(self):
-        while self.alive:
-            try:
-                stream_data = self.streams.get(timeout=self.timeout)
-
-                (writer, reader) = stream_data
-                request_finished = False
-                '''
-                To share bandwidth_limit among several requests,
-                provide to each request a proportional number
-                of chunk transfer operations
-                '''
-                proportional_bw = 16
-
-                for _ in range(proportional_bw):
-                    try:
-                        chunk = self._read_chunk(reader)
-                        if chunk:
-                            self._write_with_timeout(writer, chunk)
-                            # Account for the transferred data
-                            self.transferred_bytes_control += len(chunk)
-                            self.number_of_iterations += 1
-                            # Wait to achieve a certain bw rate on this flow
-                            time.sleep(max(0, self.dynamic_sleep))
-                        else:
-                            if hasattr(reader, 'close'):
-                                reader.close()
-                            writer.close()
-                            request_finished = True
-                            break
-
-                    except IOError as e:
-                        request_finished = True
-                        self.logger.info("Pipe error: " + str(e))
-                        break
-                    except Exception as e:
-                        request_finished = True
-                        self.logger.info("An unknown error occurred during "
-                                         "transfer: " + str(e))
-                        break
-                    except Timeout as e:
-                        request_finished = True
-                        self.logger.info("Timeout occurred during transfer: " + str(e))
-                        break
-
-                if not request_finished:
-                    self.streams.put(stream_data)
-
-            except Queue.Empty:
-                self.alive = False
-
-
-class DataFdIter(object):
-    def __init__(self, obj_data, timeout):
+        with self.streams_lock:
+            waits = [stream.wait_time() for stream in self.streams if stream.requested is not None]
+            if not waits:
+                self.scheduled = False
+                return None
+        return time.time() + max(self.node.wait_time(), min(waits))
+
+    def serve(self):
+        """
+        Deficit round robin over the streams while the class can send:
+        on its turn, a stream gets a quantum of bytes proportional to its
+        weight and is granted chunks until spending it. Streams whose
+        reader is not asking for data are skipped, so they do not hold
+        the rest.
+        """
+        stalled = 0
+        while not self.node.wait_time():
+            with self.streams_lock:
+                if stalled >= len(self.streams):
+                    break
+                stream = self.streams[0]
+                if not stream.ready():
+                    stalled += 1
+                    self.streams.rotate(-1)
+                    continue
+            stalled = 0
+
+            if stream.deficit <= 0:
+                stream.deficit += STREAM_QUANTUM * stream.weight
+            size = stream.grant()
+            stream.deficit -= size
+            self.node.consume(size)
+            if stream.deficit <= 0:
+                with self.streams_lock:
+                    if self.streams and self.streams[0] is stream:
+                        self.streams.rotate(-1)
+
+        return self.reschedule_instant()
+
+
+class BandwidthStream(object):
+    """
+    Position of a single request in its bandwidth class.
+    """
+
+    def __init__(self, weight=1, bucket=None):
+        self.weight = weight
+        # Limit of the request alone, if any
+        self.bucket = bucket
+        # Bytes left to send in the current round
+        self.deficit = 0
+        # Bytes the request is waiting to move, None if not waiting
+        self.requested = None
+        self.granted = Event()
+
+    def ready(self):
+        return self.requested is not None and not self.wait_time()
+
+    def wait_time(self):
+        if self.bucket:
+            return self.bucket.wait_time()
+        return 0
+
+    def request(self, size):
+        self.granted.clear()
+        self.requested = size
+
+    def grant(self):
+        size = self.requested
+        self.requested = None
+        if self.bucket:
+            self.bucket.consume(size)
+        self.granted.set()
+        return size
+
+    def wait(self):
+        self.granted.wait()
+
+
+class TokenBucket(object):
+    """
+    Rate limiter that allows rate bytes per second, with bursts of up to
+    burst bytes. Bytes are consumed once moved, so the bucket can go into
+    debt; the debt is the exact wait before moving more bytes.
+    """
+
+    def __init__(self, rate, burst, floor=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # Lowest debt, if bounded
+        self.floor = floor
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, size):
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+            if self.floor is not None:
+                self.tokens = max(self.tokens, self.floor)
+
+    def wait_time(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 0:
+                return 0
+            if not self.rate:
+                return float('inf')
+            return -self.tokens / self.rate
+
+    def update_rate(self, rate):
+        with self.lock:
+            # Tokens earned so far count at the previous rate
+            self._refill()
+            self.rate = float(rate)
+
+
+class HTBNode(object):
+    """
+    Node of a hierarchical token bucket. It sends at its assured rate by
+    itself and borrows the unused bandwidth of its parent up to its ceil.
+    The bytes sent are charged to the node and to all its ancestors.
+    """
+
+    def __init__(self, name, rate, ceil, burst, parent=None):
+        self.name = name
+        self.rate = rate
+        self.ceil = max(ceil, rate)
+        self.parent = parent
+        # Debt of borrowed bytes is bounded, as they were not assured
+        self.rate_bucket = TokenBucket(rate * MB, burst * MB, floor=-burst * MB)
+        self.ceil_bucket = TokenBucket(self.ceil * MB, burst * MB)
+
+    def wait_time(self):
+        """
+        Seconds until the node can send: below its ceil, and either within
+        its rate or able to borrow.
+        """
+        wait = self.rate_bucket.wait_time()
+        if wait and self.parent is not None:
+            wait = min(wait, self.parent.wait_time())
+        return max(wait, self.ceil_bucket.wait_time())
+
+    def consume(self, size):
+        self.rate_bucket.consume(size)
+        self.ceil_bucket.consume(size)
+        if self.parent is not None:
+            self.parent.consume(size)
+
+    def update(self, rate=None, ceil=None):
+        if rate is not None:
+            self.rate = rate
+            self.rate_bucket.update_rate(rate * MB)
+        if ceil is not None or self.ceil < self.rate:
+            self.ceil = max(ceil if ceil is not None else self.ceil, self.rate)
+            self.ceil_bucket.update_rate(self.ceil * MB)
+
+
+class ThrottledIter(object):
+    """
+    Wraps the data of a request and waits for its bandwidth class before
+    handing out every chunk. It can be used as the response app_iter or
+    as the wsgi.input of a PUT.
+    """
+
+    def __init__(self, data_iter, bw_class, weight=1, bucket=None):
         self.closed = False
-        self.obj_data = obj_data
-        self.timeout = timeout
+        self.data_iter = data_iter
+        self.source = iter(data_iter)
+        self.bw_class = bw_class
+        self.stream = BandwidthStream(weight, bucket)
+        self.bw_class.add_stream(self.stream)
         self.buf = b''
 
     def __iter__(self):
         return self
 
-    def read_with_timeout(self, size):
+    def _next_chunk(self):
         try:
-            with Timeout(self.timeout):
-                chunk = os.read(self.obj_data, size)
-        except Timeout:
-            self.close()
-            raise
-        except Exception:
+            chunk = next(self.source)
+        except StopIteration:
             self.close()
-            raise
+            return b''
+        if chunk:
+            self.bw_class.acquire(self.stream, len(chunk))
         return chunk
 
-    def next(self, size=64 * 1024):
+    def _fill(self):
+        # Appends the next non empty chunk to buf, False once finished
+        chunk = b''
+        while not chunk and not self.closed:
+            chunk = self._next_chunk()
+        self.buf += chunk
+        return bool(chunk)
+
+    def next(self, size=CHUNK_SIZE):
         if len(self.buf) < size:
-            r, _, _ = select.select([self.obj_data], [], [], self.timeout)
-            if len(r) == 0:
-                self.close()
-
-            if self.obj_data in r:
-                self.buf += self.read_with_timeout(size - len(self.buf))
-                if self.buf == b'':
-                    self.close()
-                    raise StopIteration('Stopped iterator ex')
-            else:
-                raise StopIteration('Stopped iterator ex')
+            self._fill()
+        if not self.buf:
+            raise StopIteration('Stopped iterator ex')
 
         if len(self.buf) > size:
             data = self.buf[:size]
@@ -471,27 +799,18 @@ class DataFdIter(object):
             self.buf = b''
         return data
 
-    def _close_check(self):
-        if self.closed:
-            raise ValueError('I/O operation on closed file')
-
-    def read(self, size=64 * 1024):
-        self._close_check()
-        return self.next(size)
+    def read(self, size=CHUNK_SIZE):
+        try:
+            return self.next(size)
+        except StopIteration:
+            return b''
 
     def readline(self, size=-1):
-        self._close_check()
-
         # read data into self.buf if there is not enough data
         while b'\n' not in self.buf and \
               (size < 0 or len(self.buf) < size):
-            if size < 0:
-                chunk = self.read()
-            else:
-                chunk = self.read(size - len(self.buf))
-            if not chunk:
+            if not self._fill():
                 break
-            self.buf += chunk
 
         # Retrieve one line from buf
         data, sep, rest = self.buf.partition(b'\n')
@@ -506,7 +825,6 @@ class DataFdIter(object):
         return data
 
     def readlines(self, sizehint=-1):
-        self._close_check()
         lines = []
         try:
             while True:
@@ -525,8 +843,10 @@ class DataFdIter(object):
     def close(self):
         if self.closed:
             return
-        os.close(self.obj_data)
         self.closed = True
+        self.bw_class.remove_stream(self.stream)
+        if hasattr(self.data_iter, 'close'):
+            self.data_iter.close()
 
     def __del__(self):
         self.close()
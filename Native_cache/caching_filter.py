@@ -1,21 +1,95 @@
-from eventlet import Timeout
-from swift.common.swob import Response
-from threading import Semaphore, Lock
+from eventlet import Timeout, tpool
+from swift.common.swob import Response, multi_range_iterator
+from threading import Semaphore, Lock, Thread, Condition, Event
+from collections import OrderedDict
 from swift.common.utils import get_logger
 from swift.common.swob import wsgify
 from swift.common.utils import register_swift_info
+from swift.common.wsgi import make_subrequest
+from array import array
+import itertools
 import hashlib
-import select
+import heapq
+import fcntl
+import mmap
+import json
+import Queue
 import time
+import uuid
 import os
 
 ENABLE_CACHE = True
-# Default cache size limit in bytes
+# Default cache size limit in bytes. Every proxy worker has its own cache, so the
+# disk used in the cache path is up to cache_max_size times the number of workers
 DEFAULT_CACHE_MAX_SIZE = 1024 * 1024  # 1 MB
-available_policies = {"LRU", "LFU"}
+available_policies = {"LRU", "LFU", "GDSF"}
+available_admission_policies = {"ALL", "TINYLFU"}
+available_coherence_modes = {"NONE", "REVALIDATE"}
+available_invalidation_buses = {"NONE", "LOCAL", "RABBIT"}
 DEFAULT_CACHE_PATH = "/tmp/cache"
 DEFAULT_EVICTION_POLICY = "LFU"
+DEFAULT_ADMISSION_POLICY = "ALL"
+DEFAULT_COHERENCE_MODE = "NONE"
+# Seconds a cached object is served before being revalidated with the backend
+DEFAULT_REVALIDATION_TTL = 30
+# Count-min sketch of the TinyLFU admission policy (one per cache segment)
+TINYLFU_SKETCH_WIDTH = 16384
+TINYLFU_SKETCH_DEPTH = 4
+TINYLFU_SAMPLE_SIZE = 10 * TINYLFU_SKETCH_WIDTH
+# Number of independently locked cache segments
+DEFAULT_CACHE_SEGMENTS = 16
+# Minimum byte budget of each cache segment
+MIN_CACHE_SEGMENT_SIZE = 1024 * 1024  # 1 MB
+# Persistent cache index files, stored in the cache path
+CACHE_INDEX_SNAPSHOT = '.cache_index'
+CACHE_INDEX_JOURNAL = '.cache_journal'
+# Journal being compacted into a new snapshot
+CACHE_INDEX_ROTATED_JOURNAL = CACHE_INDEX_JOURNAL + '.old'
+# Every proxy worker caches in its own subdirectory of the cache path, locked while it runs
+CACHE_WORKER_DIR = 'worker_'
+CACHE_WORKER_LOCK = '.lock'
+# Seconds after which a temporary file of a fill is considered abandoned
+CACHE_TMP_MAX_AGE = 3600
+# Compact the journal into a new snapshot every N records or seconds
+CACHE_INDEX_SNAPSHOT_RECORDS = 1000
+CACHE_INDEX_SNAPSHOT_INTERVAL = 300
+# In-memory tier for small hot objects
+DEFAULT_RAM_CACHE_MAX_SIZE = 8 * 1024 * 1024  # 8 MB
+DEFAULT_RAM_OBJECT_MAX_SIZE = 64 * 1024  # 64 KB
+RAM_PROMOTION_HITS = 2
+# Bytes waiting to be written to the cache before new fills are dropped
+DEFAULT_WRITE_BEHIND_MAX_SIZE = 32 * 1024 * 1024  # 32 MB
 CHUNK_SIZE = 65536
+# CacheWriter control items
+FILL_END = object()
+FILL_ABORT = object()
+# CacheFill states
+FILL_WRITING = 'writing'
+FILL_PUBLISHED = 'published'
+FILL_DISCARDED = 'discarded'
+# Seconds a coalesced cache miss waits for the fill it is attached to
+FLIGHT_TIMEOUT = 10
+# Invalidations sent to the other proxies
+DEFAULT_INVALIDATION_BUS = "NONE"
+INVALIDATION_BATCH_INTERVAL = 0.1
+INVALIDATION_BATCH_MAX = 1000
+DEFAULT_RABBIT_HOST = 'controller'
+DEFAULT_RABBIT_PORT = 5672
+DEFAULT_RABBIT_USER = 'openstack'
+DEFAULT_RABBIT_PASS = 'openstack'
+INVALIDATION_EXCHANGE = 'amq.topic'
+INVALIDATION_ROUTING_KEY = 'cache_invalidation'
+# Seconds between reconnections of the invalidation consumer, doubled on every failure
+INVALIDATION_RETRY_MIN = 1
+INVALIDATION_RETRY_MAX = 60
+# WSGI path serving the cache metrics in the Prometheus text format
+DEFAULT_METRICS_PATH = '/cache/metrics'
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+# Objects larger than the block size are cached by fixed-size blocks
+DEFAULT_CACHE_BLOCK_SIZE = 4 * 1024 * 1024  # 4 MB
+# Block layouts of large objects kept in memory
+MAX_BLOCK_LAYOUTS = 10000
 
 
 class Singleton(type):
@@ -51,8 +125,35 @@ class CacheControlFilter(object):
         self.cache_max_size = self._get_cache_max_size()
         self.cache_path = self._get_cache_path()
         self.eviction_policy = self._get_eviction_policy()
-
-        self.cache = BlockCache(self.cache_max_size, self.eviction_policy)
+        self.admission_policy = self._get_admission_policy()
+        self.cache_segments = self._get_cache_segments()
+        self.coherence_mode = self._get_coherence_mode()
+        self.revalidation_ttl = self._get_revalidation_ttl()
+
+        self.ram_cache_max_size = self._get_ram_cache_max_size()
+        self.ram_object_max_size = self._get_ram_object_max_size()
+        self.write_behind_max_size = self._get_write_behind_max_size()
+        self.cache_block_size = self._get_cache_block_size()
+        self.metrics_path = self.parameters.get('metrics_path', DEFAULT_METRICS_PATH)
+
+        self.cache = BlockCache(self.cache_max_size, self.eviction_policy, self.cache_segments,
+                                self.admission_policy)
+        self.memory_tier = MemoryTier(self.ram_cache_max_size, self.ram_object_max_size)
+        self.writer = CacheWriter(self.logger, self.write_behind_max_size)
+        self.metrics = CacheMetrics(self.logger)
+
+        # Cache misses being fetched from the backend, by object ID
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+        # Objects cached by blocks, by object ID
+        self.layouts = OrderedDict()
+        self.layouts_lock = Lock()
+        # Set up on the first request of each proxy worker
+        self.index = None
+        self.worker_pid = None
+        self.worker_lock = Lock()
+        self.cache_lock_fd = None
+        self.invalidation_bus = self._create_invalidation_bus()
 
     def register_info(self):
         register_swift_info('cache_control_filter')
@@ -75,27 +176,336 @@ class CacheControlFilter(object):
             eviction_policy = self.parameters['eviction_policy']
         return eviction_policy
 
+    def _get_admission_policy(self):
+        admission_policy = DEFAULT_ADMISSION_POLICY
+        if 'admission_policy' in self.parameters:
+            admission_policy = self.parameters['admission_policy']
+        return admission_policy
+
+    def _get_coherence_mode(self):
+        coherence_mode = DEFAULT_COHERENCE_MODE
+        if 'coherence_mode' in self.parameters:
+            coherence_mode = self.parameters['coherence_mode']
+        if coherence_mode not in available_coherence_modes:
+            raise Exception('Coherence mode ' + coherence_mode + ' not available')
+        return coherence_mode
+
+    def _get_revalidation_ttl(self):
+        revalidation_ttl = DEFAULT_REVALIDATION_TTL
+        if 'revalidation_ttl' in self.parameters:
+            revalidation_ttl = int(self.parameters['revalidation_ttl'])
+        return revalidation_ttl
+
+    def _create_invalidation_bus(self):
+        bus = self.parameters.get('invalidation_bus', DEFAULT_INVALIDATION_BUS)
+        if bus not in available_invalidation_buses:
+            raise Exception('Invalidation bus ' + bus + ' not available')
+        if bus == "NONE":
+            return None
+        if bus == "LOCAL":
+            transport = LocalInvalidationTransport()
+        else:
+            transport = RabbitInvalidationTransport(self.logger,
+                                                    self.parameters.get('rabbit_host', DEFAULT_RABBIT_HOST),
+                                                    int(self.parameters.get('rabbit_port', DEFAULT_RABBIT_PORT)),
+                                                    self.parameters.get('rabbit_user', DEFAULT_RABBIT_USER),
+                                                    self.parameters.get('rabbit_pass', DEFAULT_RABBIT_PASS))
+        return InvalidationBus(self.logger, transport, self._invalidate_cached_object)
+
+    def _get_cache_segments(self):
+        cache_segments = DEFAULT_CACHE_SEGMENTS
+        if 'cache_segments' in self.parameters:
+            cache_segments = int(self.parameters['cache_segments'])
+        return cache_segments
+
+    def _get_ram_cache_max_size(self):
+        ram_cache_max_size = DEFAULT_RAM_CACHE_MAX_SIZE
+        if 'ram_cache_max_size' in self.parameters:
+            ram_cache_max_size = int(self.parameters['ram_cache_max_size'])
+        return ram_cache_max_size
+
+    def _get_ram_object_max_size(self):
+        ram_object_max_size = DEFAULT_RAM_OBJECT_MAX_SIZE
+        if 'ram_object_max_size' in self.parameters:
+            ram_object_max_size = int(self.parameters['ram_object_max_size'])
+        return ram_object_max_size
+
+    def _get_write_behind_max_size(self):
+        write_behind_max_size = DEFAULT_WRITE_BEHIND_MAX_SIZE
+        if 'write_behind_max_size' in self.parameters:
+            write_behind_max_size = int(self.parameters['write_behind_max_size'])
+        return write_behind_max_size
+
+    def _get_cache_block_size(self):
+        cache_block_size = DEFAULT_CACHE_BLOCK_SIZE
+        if 'cache_block_size' in self.parameters:
+            cache_block_size = int(self.parameters['cache_block_size'])
+        return cache_block_size
+
+    def _start_worker(self):
+        """
+        Proxy workers share the cache path but not their caches, and the
+        filter is built before they are forked. On its first request, every
+        worker takes a subdirectory of the cache path of its own, restores
+        the cache index found there and starts its own threads.
+        """
+        with self.worker_lock:
+            if self.worker_pid == os.getpid():
+                return
+            self.writer.start()
+            if self.invalidation_bus:
+                self.invalidation_bus.start()
+            if os.path.exists(self.cache_path):
+                self.cache_path = self._lock_worker_dir(self.cache_path)
+            self.index = CacheIndex(self.cache_path)
+            if os.path.exists(self.cache_path):
+                self._load_cache_index()
+            self.worker_pid = os.getpid()
+
+    def _lock_worker_dir(self, cache_path):
+        """
+        Returns the first worker directory not locked by another worker. The
+        lock is held until the worker exits, so a restarted worker takes over
+        the directory of a previous one.
+        """
+        slot = 0
+        while True:
+            worker_path = os.path.join(cache_path, CACHE_WORKER_DIR + str(slot))
+            try:
+                os.mkdir(worker_path)
+            except OSError:
+                # Already created by a previous or concurrent worker
+                pass
+            lock_fd = os.open(os.path.join(worker_path, CACHE_WORKER_LOCK), os.O_WRONLY | os.O_CREAT)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(lock_fd)
+                slot += 1
+                continue
+            self.cache_lock_fd = lock_fd
+            return worker_path
+
+    def _load_cache_index(self):
+        """
+        Restores the descriptors of the previous run and removes the cached
+        files that are not in the index or whose size does not match it.
+        """
+        records = self.index.load()
+        cached_files = set(os.listdir(self.cache_path)) - {CACHE_INDEX_SNAPSHOT, CACHE_INDEX_JOURNAL,
+                                                           CACHE_INDEX_ROTATED_JOURNAL, CACHE_WORKER_LOCK}
+        restored = set()
+
+        # Restore in access order so that LRU order is preserved
+        for descriptor in sorted(records.values(), key=lambda desc: desc.last_access):
+            object_file = os.path.join(self.cache_path, descriptor.block_id)
+            if descriptor.block_id not in cached_files or os.path.getsize(object_file) != descriptor.size:
+                continue
+            if descriptor.layout:
+                # Blocks of the same object share its layout
+                layout = self.layouts.setdefault(descriptor.layout.object_id, descriptor.layout)
+                if layout.etag != descriptor.layout.etag:
+                    continue
+                descriptor.layout = layout
+            to_evict = self.cache.restore(descriptor)
+            if to_evict is not None:
+                restored.add(descriptor.block_id)
+                restored.difference_update(to_evict)
+                self._remove_cached_objects(to_evict, journal=False)
+
+        # Orphaned, partially written or stale files
+        now = time.time()
+        for file_name in cached_files - restored:
+            file_path = os.path.join(self.cache_path, file_name)
+            if file_name.endswith('.tmp') and now - os.path.getmtime(file_path) < CACHE_TMP_MAX_AGE:
+                # Possibly still being written: only abandoned ones are removed
+                continue
+            os.remove(file_path)
+
+        while len(self.layouts) > MAX_BLOCK_LAYOUTS:
+            self.layouts.popitem(last=False)
+        self.index.snapshot(lambda: self.cache.descriptors)
+        self.logger.info('Cache Filter - Restored ' + str(len(restored)) + ' objects from the cache index')
+
+    def _remove_cached_objects(self, to_evict, journal=True):
+        for ev_object_id in to_evict:
+            self.memory_tier.demote(ev_object_id)
+            try:
+                os.remove(os.path.join(self.cache_path, ev_object_id))
+            except OSError:
+                # Already removed by a concurrent invalidation
+                pass
+            if journal:
+                self.index.record_remove(ev_object_id)
+
+    def _invalidate_cached_object(self, object_id):
+        with self.in_flight_lock:
+            flight = self.in_flight.pop(object_id, None)
+            if flight:
+                flight.cancel()
+        if self.cache.remove(object_id):
+            self._remove_cached_objects([object_id])
+
+        with self.layouts_lock:
+            layout = self.layouts.pop(object_id, None)
+        if layout:
+            for index in range(layout.block_count):
+                block_id = layout.block_id(index)
+                with self.in_flight_lock:
+                    flight = self.in_flight.pop(block_id, None)
+                    if flight:
+                        flight.cancel()
+                if self.cache.remove(block_id):
+                    self._remove_cached_objects([block_id])
+
+    def _add_block_layout(self, layout):
+        with self.layouts_lock:
+            self.layouts[layout.object_id] = layout
+            if len(self.layouts) > MAX_BLOCK_LAYOUTS:
+                # The blocks of a forgotten layout are no longer hit and age out of the cache
+                self.layouts.popitem(last=False)
+
+    def _get_block_layout(self, object_id):
+        with self.layouts_lock:
+            layout = self.layouts.pop(object_id, None)
+            if layout:
+                self.layouts[object_id] = layout
+            return layout
+
+    def _snapshot_cache_index(self):
+        if self.index.snapshot_due():
+            self.index.snapshot_async(lambda: self.cache.descriptors)
+
     @wsgify
     def __call__(self, req):
+        if self.worker_pid != os.getpid():
+            self._start_worker()
+
         object_path = req.environ['PATH_INFO']
+        if object_path == self.metrics_path and req.method == 'GET':
+            return self._get_metrics(req)
+
         object_id = (hashlib.md5(object_path).hexdigest())
         if req.method == 'GET':
+            start = time.time()
             if self.cache.is_object_in_cache(object_id):
                 self.logger.info('Cache Filter - Object '+object_path+' in cache')
-                return self.get_cached_object(req, object_id)
-
-            resp = req.get_response(self.app)
-            if resp.is_success:
-                data_iter = resp.app_iter
-                resp.app_iter = self._put_object_in_cache(resp, object_id, data_iter)
-            return resp
+                descriptor = self.cache.get_descriptor(object_id)
+                if descriptor and self._revalidate(req, object_id, descriptor):
+                    resp = self._get_cached_object(req, object_id)
+                    # The object may have been evicted after the membership check
+                    if resp:
+                        self.metrics.incr('cache_hits_total')
+                        self.metrics.observe('cache_hit_latency_seconds', time.time() - start)
+                        return resp
+
+            layout = self._get_block_layout(object_id)
+            if layout and self._revalidate(req, object_id, layout):
+                self.metrics.incr('cache_block_object_requests_total')
+                return self._get_object_from_blocks(req, layout)
+
+            self.metrics.incr('cache_misses_total')
+            self.cache.record(object_id)
+            return self._get_object_from_backend(req, object_id)
 
         elif req.method == 'PUT':
+            # The cached copy is outdated from now on
+            self._invalidate_cached_object(object_id)
+            self.cache.record(object_id)
             reader = req.environ['wsgi.input'].read
             data_iter = iter(lambda: reader(65536), '')
-            req.environ['wsgi.input'] = self._put_object_in_cache(req, object_id, data_iter)
-
-        return req.get_response(self.app)
+            req.environ['wsgi.input'], fills = self._put_object_in_cache(req, object_id, data_iter)
+            if fills:
+                return self._put_object(req, object_id, fills)
+
+        elif req.method in ('DELETE', 'POST'):
+            self._invalidate_cached_object(object_id)
+
+        resp = req.get_response(self.app)
+        if self.invalidation_bus and req.method in ('PUT', 'DELETE', 'POST'):
+            # Once written, so that other proxies do not cache the old version again
+            self.invalidation_bus.publish(object_id)
+        return resp
+
+    def _put_object(self, req, object_id, fills):
+        """
+        Stores an object in the backend while caching its body. The cached
+        copy is only published once the backend has stored the object.
+        """
+        fills.hold()
+        stored = False
+        try:
+            resp = req.get_response(self.app)
+            stored = resp.is_success
+        finally:
+            fills.release(stored)
+            if not stored:
+                self._invalidate_cached_object(object_id)
+        if self.invalidation_bus:
+            self.invalidation_bus.publish(object_id)
+        return resp
+
+    def _revalidate(self, req, object_id, cached_entry):
+        """
+        In REVALIDATE coherence mode, checks with a conditional HEAD that a
+        cached object (a descriptor or a block layout) has not been
+        modified or deleted through another proxy. Each entry is checked at
+        most once per revalidation TTL. Returns False if the cached copy
+        cannot be served.
+        """
+        if self.coherence_mode == "NONE":
+            return True
+        now = time.time()
+        if now - cached_entry.validated_at < self.revalidation_ttl:
+            return True
+        # Concurrent hits keep serving the entry while it is being revalidated
+        cached_entry.validated_at = now
+
+        headers = {'If-None-Match': cached_entry.etag}
+        if 'X-Auth-Token' in req.headers:
+            headers['X-Auth-Token'] = req.headers['X-Auth-Token']
+        sub_req = make_subrequest(req.environ, 'HEAD', req.path, headers=headers,
+                                  swift_source='cache_control_filter')
+        resp = sub_req.get_response(self.app)
+        resp_etag = resp.headers.get('ETag', '').strip('"')
+        self.metrics.incr('cache_revalidations_total')
+        if resp.status_int == 304 or (resp.is_success and resp_etag == cached_entry.etag.strip('"')):
+            return True
+
+        # Unknown state of the object: do not serve it until the next revalidation
+        cached_entry.validated_at = 0
+        if resp.status_int == 404 or resp.is_success:
+            self.logger.info('Cache Filter - Object ' + req.environ['PATH_INFO'] +
+                             ' modified in the backend, invalidating it')
+            self.metrics.incr('cache_stale_objects_total')
+            self._invalidate_cached_object(object_id)
+        return False
+
+    def _get_metrics(self, req):
+        gauges = {'cache_size_bytes': self.cache.cache_size_bytes,
+                  'cache_max_size_bytes': self.cache.cache_max_size,
+                  'cache_objects': len(self.cache.descriptors_dict),
+                  'cache_block_objects': len(self.layouts),
+                  'cache_ram_size_bytes': self.memory_tier.size_bytes,
+                  'cache_ram_max_size_bytes': self.memory_tier.max_size,
+                  'cache_write_behind_bytes': self.writer.pending_bytes}
+        counters = {'cache_lookup_hits_total': self.cache.get_hits,
+                    'cache_lookup_misses_total': self.cache.misses,
+                    'cache_put_hits_total': self.cache.put_hits,
+                    'cache_evictions_total': self.cache.evictions,
+                    'cache_rejections_total': self.cache.rejections,
+                    'cache_lock_wait_seconds_total': self.cache.lock_wait}
+        return Response(body=self.metrics.render(gauges, counters), request=req,
+                        content_type='text/plain; version=0.0.4')
+
+    def _served_bytes(self, req, size):
+        if not req.range:
+            return size
+        ranges = req.range.ranges_for_length(size)
+        if ranges is None:
+            # Range header ignored, the whole object is served
+            return size
+        return sum(stop - start for start, stop in ranges)
 
     def _get_cached_object(self, req, object_id):
         object_id, object_size, object_etag, object_storage_policy_id = self.cache.access_cache("GET", object_id)
@@ -105,38 +515,292 @@ class CacheControlFilter(object):
             resp_headers['Content-Length'] = str(object_size)
             resp_headers['Etag'] = object_etag
 
-            # Using os.open() instead of python open() to avoid sequentialization
-            cached_object_fd = os.open(os.path.join(self.cache_path, object_id), os.O_RDONLY)
-
             req.environ['HTTP_X_BACKEND_STORAGE_POLICY_INDEX'] = object_storage_policy_id
-            data_iter = FdIter(cached_object_fd, 10)
+            self._snapshot_cache_index()
+            self.metrics.incr('cache_hit_bytes_total', self._served_bytes(req, object_size))
+
+            data = self.memory_tier.get(object_id)
+            if data is None:
+                descriptor = self.cache.get_descriptor(object_id)
+                if descriptor and self.memory_tier.is_promotable(descriptor):
+                    data = self._read_cached_object(object_id, object_size)
+                    if data is not None:
+                        self.memory_tier.promote(descriptor, data)
+
+            if data is not None:
+                # Small hot object served from RAM as a single chunk
+                return Response(body=data, headers=resp_headers, request=req, conditional_response=True)
+
+            try:
+                # Using os.open() instead of python open() to avoid sequentialization
+                cached_object_fd = os.open(os.path.join(self.cache_path, object_id), os.O_RDONLY)
+            except OSError:
+                # Evicted by a concurrent request
+                return None
+            data_iter = MmapIter(cached_object_fd)
+
+            # Range and conditional requests are served by swob from the cached file
+            return Response(app_iter=data_iter, headers=resp_headers, request=req, conditional_response=True)
+
+    def _get_object_from_backend(self, req, object_id):
+        """
+        Cache miss. Only the first concurrent request of an object fetches
+        and caches it; the others attach to its fill and stream the object
+        from the cache file as it is written.
+        """
+        if req.range:
+            # A partial body cannot be cached as the whole object
+            return self._count_backend_bytes(req.get_response(self.app))
+
+        with self.in_flight_lock:
+            flight = self.in_flight.get(object_id)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[object_id] = CacheFlight()
+
+        if not leader:
+            resp = self._get_object_from_flight(req, flight)
+            if resp:
+                return resp
+            layout = self._get_block_layout(object_id)
+            if layout:
+                # The first request is caching the object by blocks
+                return self._get_object_from_blocks(req, layout)
+            return self._count_backend_bytes(req.get_response(self.app))
+
+        fill = None
+        try:
+            resp = self._count_backend_bytes(req.get_response(self.app))
+            if resp.status_int == 200:
+                layout = self._create_block_layout(resp, object_id)
+                if layout:
+                    self._add_block_layout(layout)
+                    block_fills = BlockFillWriter(layout, self._create_block_fill)
+                    resp.app_iter = DataIter(resp.app_iter, 10, block_fills, self._write_object_into_cache)
+                    resp.content_length = layout.size
+                    return resp
+
+                fill = self._create_cache_fill(resp, object_id)
+                if fill:
+                    fill.on_done = lambda: self._end_flight(object_id, flight)
+                    resp_headers = dict(resp.headers)
+                    resp.app_iter = DataIter(resp.app_iter, 10, fill, self._write_object_into_cache)
+                    # Setting app_iter drops the Content-Length
+                    resp.content_length = fill.size
+                    flight.start(fill, resp_headers)
+            return resp
+        finally:
+            if not fill:
+                flight.start(None, None)
+                self._end_flight(object_id, flight)
+
+    def _count_backend_bytes(self, resp):
+        if resp.is_success and resp.content_length:
+            self.metrics.incr('cache_backend_bytes_total', resp.content_length)
+        return resp
+
+    def _get_object_from_flight(self, req, flight):
+        if not flight.ready.wait(FLIGHT_TIMEOUT) or not flight.fill:
+            return None
+        fill = flight.fill
+        self.logger.info('Cache Filter - Object ' + req.environ['PATH_INFO'] +
+                         ' attached to an in-flight cache fill')
+        data_iter = FillFollowerIter(fill, lambda offset: self._get_object_range(req, offset, fill.etag))
+        return Response(app_iter=data_iter, headers=flight.headers, request=req)
+
+    def _get_object_range(self, req, start, etag, stop=None):
+        byte_range = 'bytes=' + str(start) + '-'
+        if stop is not None:
+            byte_range += str(stop - 1)
+        headers = {'Range': byte_range, 'If-Match': etag}
+        if 'X-Auth-Token' in req.headers:
+            headers['X-Auth-Token'] = req.headers['X-Auth-Token']
+        sub_req = make_subrequest(req.environ, 'GET', req.path, headers=headers,
+                                  swift_source='cache_control_filter')
+        resp = sub_req.get_response(self.app)
+        if resp.status_int != 206:
+            if resp.status_int == 412:
+                # The object has been modified in the backend
+                self._invalidate_cached_object(hashlib.md5(req.environ['PATH_INFO']).hexdigest())
+            raise Exception('Cache Filter - Unable to read object ' + req.path +
+                            ' from the backend: ' + resp.status)
+        return iter(resp.app_iter)
+
+    def _get_object_from_blocks(self, req, layout):
+        """
+        Serves an object cached by blocks. The cached blocks are read from
+        the cache and the missing ones are requested to the backend with
+        ranged GETs, which also cache them.
+        """
+        resp_headers = {}
+        resp_headers['Content-Length'] = str(layout.size)
+        resp_headers['Etag'] = layout.etag
+        resp_headers['Content-Type'] = layout.content_type
+
+        req.environ['HTTP_X_BACKEND_STORAGE_POLICY_INDEX'] = layout.storage_policy_id
+        data_iter = BlockAssemblyIter(layout, lambda index, start, stop:
+                                      self._read_block(req, layout, index, start, stop))
+        return Response(app_iter=data_iter, headers=resp_headers, request=req, conditional_response=True)
+
+    def _read_block(self, req, layout, index, start, stop):
+        """
+        Yields the bytes [start, stop) of a block, relative to the block.
+        """
+        block_id = layout.block_id(index)
+        block_start, block_stop = layout.block_range(index)
+
+        if self.cache.access_cache("GET", block_id)[0]:
+            try:
+                cached_block_fd = os.open(os.path.join(self.cache_path, block_id), os.O_RDONLY)
+            except OSError:
+                # Evicted by a concurrent request
+                cached_block_fd = None
+            if cached_block_fd is not None:
+                self.metrics.incr('cache_block_hits_total')
+                self.metrics.incr('cache_hit_bytes_total', stop - start)
+                for chunk in MmapIter(cached_block_fd).app_iter_range(start, stop):
+                    yield chunk
+                return
+
+        self.metrics.incr('cache_block_misses_total')
+        self.metrics.incr('cache_backend_bytes_total', stop - start)
+        fill = self._create_block_fill(layout, index)
+        if not fill:
+            for chunk in self._get_object_range(req, block_start + start, layout.etag, block_start + stop):
+                yield chunk
+            return
 
-            return Response(app_iter=data_iter, headers=resp_headers, request=req)
+        # The whole block is read to cache it, but only the requested bytes are returned
+        data_iter = DataIter(self._get_object_range(req, block_start, layout.etag, block_stop),
+                             10, fill, self._write_object_into_cache)
+        offset = 0
+        try:
+            for chunk in data_iter:
+                chunk_start = offset
+                offset += len(chunk)
+                if offset > start and chunk_start < stop:
+                    yield chunk[max(start - chunk_start, 0):stop - chunk_start]
+        finally:
+            data_iter.close()
+
+    def _end_flight(self, object_id, flight):
+        with self.in_flight_lock:
+            if self.in_flight.get(object_id) is flight:
+                del self.in_flight[object_id]
+
+    def _read_cached_object(self, object_id, object_size):
+        try:
+            with open(os.path.join(self.cache_path, object_id), 'rb') as cached_object:
+                data = cached_object.read()
+        except IOError:
+            return None
+        if len(data) != object_size:
+            # Still being written
+            return None
+        return data
 
     def _put_object_in_cache(self, req_resp, object_id, data_iter):
-        if os.path.exists(self.cache_path):
+        layout = self._create_block_layout(req_resp, object_id)
+        if layout:
+            self._add_block_layout(layout)
+            block_fills = BlockFillWriter(layout, self._create_block_fill)
+            return DataIter(data_iter, 10, block_fills, self._write_object_into_cache), block_fills
+
+        cached_object = self._create_cache_fill(req_resp, object_id)
+        if cached_object:
+            return DataIter(data_iter, 10, cached_object, self._write_object_into_cache), cached_object
+        return data_iter, None
+
+    def _create_cache_fill(self, req_resp, object_id):
+        if os.path.exists(self.cache_path) and req_resp.headers.get('Content-Length'):
             object_path = req_resp.environ['PATH_INFO']
-            object_size = int(req_resp.headers.get('Content-Length', ''))
+            object_size = int(req_resp.headers['Content-Length'])
             object_etag = req_resp.headers.get('ETag', '')
             object_storage_policy_id = self._get_storage_policy_id(req_resp)
-            object_id = (hashlib.md5(object_path).hexdigest())
-
-            to_evict = self.cache.access_cache("PUT", object_id, object_size, object_etag, object_storage_policy_id)
 
-            for ev_object_id in to_evict:
-                os.remove(os.path.join(self.cache_path, ev_object_id))
+            if object_size > self.cache_block_size or not self.cache.admits(object_id, object_size):
+                # The object does not fit in the cache or is not worth it
+                return None
 
             self.logger.info('Cache Filter - Storing object ' + object_path +
                              ' in cache with ID: ' + object_id)
 
-            cached_object = open(os.path.join(self.cache_path, object_id), 'w')
-
-            return DataIter(data_iter, 10, cached_object, self._write_object_into_cache)
+            return CacheFill(self.writer, self.cache_path, object_id, object_size,
+                             object_etag, object_storage_policy_id, self._publish_cached_object)
+        return None
+
+    def _create_block_layout(self, req_resp, object_id):
+        if not os.path.exists(self.cache_path) or not req_resp.headers.get('Content-Length'):
+            return None
+        object_size = int(req_resp.headers['Content-Length'])
+        object_etag = req_resp.headers.get('ETag', '').strip('"')
+        if object_size <= self.cache_block_size or not object_etag:
+            # Small objects are cached whole, and blocks are keyed by etag
+            return None
+        if self.cache_block_size >= self.cache.segment_max_size:
+            # No block would be admitted: pass the object through
+            return None
+
+        self.logger.info('Cache Filter - Storing object ' + req_resp.environ['PATH_INFO'] +
+                         ' in cache by blocks with ID: ' + object_id)
+        return BlockLayout(object_id, object_size, object_etag, self._get_storage_policy_id(req_resp),
+                           req_resp.headers.get('Content-Type', ''), self.cache_block_size)
+
+    def _create_block_fill(self, layout, index):
+        block_id = layout.block_id(index)
+        block_start, block_stop = layout.block_range(index)
+        if self.cache.is_object_in_cache(block_id) or not self.cache.admits(block_id, block_stop - block_start):
+            return None
+
+        with self.in_flight_lock:
+            if block_id in self.in_flight:
+                # Being cached by another request
+                return None
+            flight = self.in_flight[block_id] = CacheFlight()
+
+        fill = CacheFill(self.writer, self.cache_path, block_id, block_stop - block_start,
+                         layout.etag, layout.storage_policy_id, self._publish_cached_object)
+        fill.layout = layout
+        fill.block_index = index
+        fill.on_done = lambda: self._end_flight(block_id, flight)
+        flight.start(fill, None)
+        return fill
 
     def _write_object_into_cache(self, cached_object, chunk):
         cached_object.write(chunk)
         return chunk
 
+    def _publish_cached_object(self, fill):
+        """
+        Registers a completely written and verified object in the cache.
+        Called by the CacheWriter once the file has its final name.
+        """
+        with self.in_flight_lock:
+            # Invalidations cancel the fill under this lock, also during its fsync
+            if fill.cancelled:
+                return False
+            to_evict = self.cache.access_cache("PUT", fill.object_id, fill.size, fill.etag,
+                                               fill.storage_policy_id)
+        if to_evict is None:
+            return False
+
+        self.metrics.incr('cache_fills_total')
+        self.metrics.incr('cache_fill_bytes_total', fill.size)
+        self.metrics.observe('cache_fill_latency_seconds', time.time() - fill.created_at)
+
+        self._remove_cached_objects(to_evict)
+        if fill.layout:
+            descriptor = self.cache.get_descriptor(fill.object_id)
+            if descriptor:
+                descriptor.layout = fill.layout
+                descriptor.block_index = fill.block_index
+        # The in-memory copy, if any, is outdated
+        self.memory_tier.demote(fill.object_id)
+        self.index.record_put(fill.object_id, fill.size, fill.etag, fill.storage_policy_id,
+                              fill.layout, fill.block_index)
+        self._snapshot_cache_index()
+        return True
+
     def _get_storage_policy_id(self, request):
         if 'HTTP_X_BACKEND_STORAGE_POLICY_INDEX' in request.environ:
             storage_policy = request.environ['HTTP_X_BACKEND_STORAGE_POLICY_INDEX']
@@ -160,6 +824,11 @@ class CacheObjectDescriptor(object):
         self.size = size
         self.etag = etag
         self.storage_policy_id = storage_policy_id
+        # Last time the object was known to be up to date in the backend
+        self.validated_at = time.time()
+        # Set for the blocks of the objects cached by blocks
+        self.layout = None
+        self.block_index = None
 
     def get_hit(self):
         self.get_hits += 1
@@ -174,100 +843,500 @@ class CacheObjectDescriptor(object):
         self.num_accesses += 1
 
 
-class BlockCache(object):
+class LRUEvictionPolicy(object):
+    """
+    Least Recently Used order kept in a linked hash map: descriptors are moved
+    to the tail on every access, so the head is always the next victim.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for block_id in reversed(self.entries):
+            yield self.entries[block_id]
 
-    def __init__(self, cache_max_size, eviction_policy):
+    def add(self, descriptor):
+        self.entries[descriptor.block_id] = descriptor
+
+    def touch(self, descriptor):
+        del self.entries[descriptor.block_id]
+        self.entries[descriptor.block_id] = descriptor
+
+    def remove(self, descriptor):
+        del self.entries[descriptor.block_id]
+
+    def peek_victim(self):
+        return self.entries[next(iter(self.entries))]
+
+    def pop_victim(self):
+        return self.entries.popitem(last=False)[1]
+
+
+class LFUEvictionPolicy(object):
+    """
+    Least Frequently Used order kept in frequency buckets: one linked hash map
+    per number of GET hits, plus the lowest non-empty frequency. Ties inside a
+    bucket are evicted in LRU order.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.frequencies = {}
+        self.min_frequency = 0
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for frequency in sorted(self.buckets, reverse=True):
+            bucket = self.buckets[frequency]
+            for block_id in reversed(bucket):
+                yield bucket[block_id]
+
+    def add(self, descriptor):
+        frequency = descriptor.get_hits
+        if not self.frequencies or frequency < self.min_frequency:
+            self.min_frequency = frequency
+        self.buckets.setdefault(frequency, OrderedDict())[descriptor.block_id] = descriptor
+        self.frequencies[descriptor.block_id] = frequency
+
+    def touch(self, descriptor):
+        old_frequency = self.frequencies[descriptor.block_id]
+        if old_frequency == descriptor.get_hits:
+            # PUT hits do not change the LFU order
+            return
+        self._unlink(descriptor.block_id, old_frequency)
+        if old_frequency == self.min_frequency and old_frequency not in self.buckets:
+            self.min_frequency = descriptor.get_hits
+        self.buckets.setdefault(descriptor.get_hits, OrderedDict())[descriptor.block_id] = descriptor
+        self.frequencies[descriptor.block_id] = descriptor.get_hits
+
+    def remove(self, descriptor):
+        self._unlink(descriptor.block_id, self.frequencies.pop(descriptor.block_id))
+
+    def peek_victim(self):
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = min(self.buckets)
+        bucket = self.buckets[self.min_frequency]
+        return bucket[next(iter(bucket))]
+
+    def pop_victim(self):
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = min(self.buckets)
+        bucket = self.buckets[self.min_frequency]
+        _, descriptor = bucket.popitem(last=False)
+        if not bucket:
+            del self.buckets[self.min_frequency]
+        del self.frequencies[descriptor.block_id]
+        return descriptor
+
+    def _unlink(self, block_id, frequency):
+        bucket = self.buckets[frequency]
+        del bucket[block_id]
+        if not bucket:
+            del self.buckets[frequency]
+
+
+class GDSFEvictionPolicy(object):
+    """
+    Greedy-Dual-Size-Frequency order: the priority of a descriptor is the
+    cache clock plus its GET hits divided by its size, so small and popular
+    blocks are kept. The clock takes the priority of every victim, which
+    ages the blocks that are no longer accessed. Kept in a heap with lazy
+    deletion, so operations are O(log n).
+    """
+
+    def __init__(self):
+        self.clock = 0.0
+        self.heap = []
+        # block_id -> heap entry [priority, sequence, descriptor]
+        self.entries = {}
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for entry in sorted(self.entries.values(), reverse=True):
+            yield entry[2]
+
+    def add(self, descriptor):
+        priority = self.clock + float(descriptor.get_hits + 1) / max(descriptor.size, 1)
+        entry = [priority, next(self.sequence), descriptor]
+        self.entries[descriptor.block_id] = entry
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            # Drop the stale entries left by touch() and remove()
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def touch(self, descriptor):
+        self.remove(descriptor)
+        self.add(descriptor)
+
+    def remove(self, descriptor):
+        entry = self.entries.pop(descriptor.block_id)
+        entry[2] = None
+
+    def peek_victim(self):
+        while self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][2]
+
+    def pop_victim(self):
+        descriptor = self.peek_victim()
+        priority = heapq.heappop(self.heap)[0]
+        del self.entries[descriptor.block_id]
+        self.clock = priority
+        return descriptor
+
+
+eviction_policies = {"LRU": LRUEvictionPolicy, "LFU": LFUEvictionPolicy, "GDSF": GDSFEvictionPolicy}
+
+
+class TinyLFUAdmission(object):
+    """
+    TinyLFU admission policy. A count-min sketch estimates how often each
+    block has been read recently, with a doorkeeper set in front of it that
+    absorbs the blocks read only once. When the cache is full, a new block
+    is only admitted if it is read more often than the next victim, so a
+    scan of cold objects cannot flush the hot set. Counters are halved
+    every TINYLFU_SAMPLE_SIZE reads to forget old popularity.
+    """
+
+    def __init__(self):
+        self.table = [array('B', [0]) * TINYLFU_SKETCH_WIDTH for _ in range(TINYLFU_SKETCH_DEPTH)]
+        self.doorkeeper = set()
+        self.additions = 0
+
+    def _indexes(self, block_id):
+        # Block IDs are md5 hex digests: each row uses a different slice
+        digest = int(block_id[:32], 16)
+        for row in range(TINYLFU_SKETCH_DEPTH):
+            yield (digest >> (row * 32)) % TINYLFU_SKETCH_WIDTH
+
+    def record(self, block_id):
+        if block_id not in self.doorkeeper:
+            self.doorkeeper.add(block_id)
+        else:
+            for row, index in zip(self.table, self._indexes(block_id)):
+                if row[index] < 255:
+                    row[index] += 1
+        self.additions += 1
+        if self.additions >= TINYLFU_SAMPLE_SIZE:
+            self._reset()
+
+    def estimate(self, block_id):
+        frequency = min(row[index] for row, index in zip(self.table, self._indexes(block_id)))
+        if block_id in self.doorkeeper:
+            frequency += 1
+        return frequency
+
+    def admit(self, candidate_id, victim_id):
+        return self.estimate(candidate_id) > self.estimate(victim_id)
+
+    def _reset(self):
+        for row in self.table:
+            for index in range(len(row)):
+                row[index] >>= 1
+        self.doorkeeper.clear()
+        self.additions //= 2
+
+
+admission_policies = {"ALL": None, "TINYLFU": TinyLFUAdmission}
+
+
+class CacheSegment(object):
+    """
+    Independently locked part of the BlockCache, with its own eviction
+    structure, statistics and byte budget.
+    """
+
+    def __init__(self, cache_max_size, eviction_policy, admission_policy=DEFAULT_ADMISSION_POLICY):
         # This will contain the actual data of each block
         self.descriptors_dict = {}
-        # Structure to store the cache metadata of each block
-        self.descriptors = []
         # Cache statistics
         self.get_hits = 0
         self.put_hits = 0
         self.misses = 0
         self.evictions = 0
+        self.rejections = 0
         self.reads = 0
         self.writes = 0
         self.cache_size_bytes = 0
         self.cache_max_size = cache_max_size
+        # Seconds spent waiting for the segment lock
+        self.lock_wait = 0.0
 
         # Eviction policy
         self.policy = eviction_policy
+        # Structure keeping the cache metadata of each block in eviction order
+        self.eviction = self._create_eviction_structure(eviction_policy)
+        # Admission policy, None to admit every block
+        self.admission = self._create_admission_policy(admission_policy)
         # Synchronize shared cache content
         self.semaphore = Semaphore()
 
-    @property
-    def is_object_in_cache(self, block_id):
-        return block_id in self.descriptors_dict
-
     def access_cache(self, operation='PUT', block_id=None, block_data=None, etag=None, storage_policy_id=None):
         result = None
         if ENABLE_CACHE:
+            start = time.time()
             self.semaphore.acquire()
-            if operation == 'PUT':
-                result = self._put(block_id, block_data, etag, storage_policy_id)
-            elif operation == 'GET':
-                result = self._get(block_id)
-            else:
-                raise Exception("Unsupported cache operation" + operation)
-            # Sort descriptors based on eviction policy order
-            self._sort_descriptors()
-            self.semaphore.release()
+            self.lock_wait += time.time() - start
+            try:
+                if operation == 'PUT':
+                    result = self._put(block_id, block_data, etag, storage_policy_id)
+                elif operation == 'GET':
+                    result = self._get(block_id)
+                else:
+                    raise Exception("Unsupported cache operation" + operation)
+            finally:
+                self.semaphore.release()
         return result
 
     def _put(self, block_id, block_size, etag, storage_policy_id):
         self.writes += 1
+        if block_size >= self.cache_max_size:
+            # The block can never fit in this segment
+            return None
         to_evict = []
+        descriptor = self.descriptors_dict.get(block_id)
         # Check if the cache is full and if the element is new
-        if self.cache_max_size <= (self.cache_size_bytes + block_size) and block_id not in self.descriptors_dict:
-            # Evict as many files as necessary until having enough space for new one
-            while (self.cache_max_size <= (self.cache_size_bytes + block_size)):
-                # Get the last element ordered by the eviction policy
-                self.descriptors, evicted = self.descriptors[:-1], self.descriptors[-1]
-                # Reduce the size of the cache
-                self.cache_size_bytes -= evicted.size
-                # Increase evictions count and add to
-                self.evictions += 1
-                to_evict.append(evicted.block_id)
-                # Remove from evictions dict
-                del self.descriptors_dict[evicted.block_id]
-
-        if block_id in self.descriptors_dict:
-            descriptor = self.descriptors_dict[block_id]
-            self.descriptors_dict[block_id].size = block_size
-            self.descriptors_dict[block_id].etag = etag
-            self.descriptors_dict[block_id].storage_policy_id = storage_policy_id
+        if self.cache_max_size <= (self.cache_size_bytes + block_size) and not descriptor:
+            if self.admission and not self.admission.admit(block_id, self.eviction.peek_victim().block_id):
+                self.rejections += 1
+                return None
+        if descriptor:
+            # A resized element makes room like a new one, without being a victim itself
+            self.eviction.remove(descriptor)
+            self.cache_size_bytes -= descriptor.size
+
+        # Evict as many files as necessary until having enough space for the element
+        while self.cache_max_size <= (self.cache_size_bytes + block_size):
+            # Get the next victim according to the eviction policy
+            evicted = self.eviction.pop_victim()
+            # Reduce the size of the cache
+            self.cache_size_bytes -= evicted.size
+            # Increase evictions count and add to
+            self.evictions += 1
+            to_evict.append(evicted.block_id)
+            # Remove from evictions dict
+            del self.descriptors_dict[evicted.block_id]
+
+        if descriptor:
+            self.cache_size_bytes += block_size
+            descriptor.size = block_size
+            descriptor.etag = etag
+            descriptor.storage_policy_id = storage_policy_id
+            descriptor.validated_at = time.time()
             descriptor.put_hit()
+            self.eviction.add(descriptor)
             self.put_hits += 1
         else:
             # Add the new element to the cache
             descriptor = CacheObjectDescriptor(block_id, block_size, etag, storage_policy_id)
-            self.descriptors.append(descriptor)
+            self.eviction.add(descriptor)
             self.descriptors_dict[block_id] = descriptor
             self.cache_size_bytes += block_size
 
-        assert len(self.descriptors) == len(self.descriptors_dict.keys()) ==\
-            len(self.descriptors_dict.keys()), "Unequal length in cache data structures"
+        assert len(self.eviction) == len(self.descriptors_dict), "Unequal length in cache data structures"
 
         return to_evict
 
+    def restore(self, descriptor):
+        """
+        Adds a descriptor recovered from the cache index, keeping its
+        access statistics. Returns the evicted blocks or None if it does
+        not fit in the segment.
+        """
+        self.semaphore.acquire()
+        try:
+            if descriptor.size >= self.cache_max_size or descriptor.block_id in self.descriptors_dict:
+                return None
+            to_evict = []
+            while self.cache_max_size <= (self.cache_size_bytes + descriptor.size):
+                evicted = self.eviction.pop_victim()
+                self.cache_size_bytes -= evicted.size
+                self.evictions += 1
+                to_evict.append(evicted.block_id)
+                del self.descriptors_dict[evicted.block_id]
+            self.eviction.add(descriptor)
+            self.descriptors_dict[descriptor.block_id] = descriptor
+            self.cache_size_bytes += descriptor.size
+            return to_evict
+        finally:
+            self.semaphore.release()
+
+    def remove(self, block_id):
+        self.semaphore.acquire()
+        try:
+            descriptor = self.descriptors_dict.pop(block_id, None)
+            if descriptor:
+                self.eviction.remove(descriptor)
+                self.cache_size_bytes -= descriptor.size
+            return descriptor
+        finally:
+            self.semaphore.release()
+
+    def admits(self, block_id, block_size):
+        """
+        Tells in advance whether a block would be admitted by a PUT, to
+        avoid writing blocks that would be rejected.
+        """
+        if block_size >= self.cache_max_size:
+            return False
+        if not self.admission:
+            return True
+        with self.semaphore:
+            if block_id in self.descriptors_dict or \
+                    self.cache_max_size > (self.cache_size_bytes + block_size):
+                return True
+            if self.admission.admit(block_id, self.eviction.peek_victim().block_id):
+                return True
+            self.rejections += 1
+            return False
+
+    def record(self, block_id):
+        """
+        Counts an access to a block that is not read from the cache, such as
+        a miss or a write, so that the admission policy learns its frequency.
+        """
+        if self.admission:
+            with self.semaphore:
+                self.admission.record(block_id)
+
     def _get(self, block_id):
         self.reads += 1
+        if self.admission:
+            self.admission.record(block_id)
         if block_id in self.descriptors_dict:
             self.descriptors_dict[block_id].get_hit()
+            self.eviction.touch(self.descriptors_dict[block_id])
             self.get_hits += 1
             return block_id, self.descriptors_dict[block_id].size, self.descriptors_dict[block_id].etag, self.descriptors_dict[block_id].storage_policy_id
         self.misses += 1
         return None, 0, '', ''
 
-    def _sort_descriptors(self):
-        # Order the descriptor list depending on the policy
-        if self.policy == "LRU":
-            self.descriptors.sort(key=lambda desc: desc.last_access, reverse=True)
-        elif self.policy == "LFU":
-            self.descriptors.sort(key=lambda desc: desc.get_hits, reverse=True)
-        else:
+    @property
+    def descriptors(self):
+        # Descriptors ordered from the most valuable to the next victim
+        return list(self.eviction)
+
+    def _create_eviction_structure(self, policy):
+        if policy not in eviction_policies:
             raise Exception("Unsupported caching policy.")
+        return eviction_policies[policy]()
+
+    def _create_admission_policy(self, policy):
+        if policy not in admission_policies:
+            raise Exception("Unsupported admission policy.")
+        if admission_policies[policy]:
+            return admission_policies[policy]()
+        return None
+
+
+class BlockCache(object):
+    """
+    Cache metadata sharded by block ID into several CacheSegments, so that
+    concurrent requests on different objects do not wait on the same lock.
+    Block IDs are md5 hex digests, so their prefix is used as the hash.
+    """
+
+    def __init__(self, cache_max_size, eviction_policy, segments=DEFAULT_CACHE_SEGMENTS,
+                 admission_policy=DEFAULT_ADMISSION_POLICY):
+        # Do not split the budget in segments too small to be useful
+        segments = max(1, min(segments, cache_max_size // MIN_CACHE_SEGMENT_SIZE))
+        self.segment_max_size = cache_max_size // segments
+        self.segments = [CacheSegment(self.segment_max_size, eviction_policy, admission_policy)
+                         for _ in range(segments)]
+        self.cache_max_size = cache_max_size
+        self.policy = eviction_policy
+        self.admission_policy = admission_policy
+
+    def _get_segment(self, block_id):
+        return self.segments[int(block_id[:8], 16) % len(self.segments)]
+
+    def is_object_in_cache(self, block_id):
+        # Lock-free: a dict membership test is atomic
+        return block_id in self._get_segment(block_id).descriptors_dict
+
+    def access_cache(self, operation='PUT', block_id=None, block_data=None, etag=None, storage_policy_id=None):
+        segment = self._get_segment(block_id)
+        return segment.access_cache(operation, block_id, block_data, etag, storage_policy_id)
+
+    def restore(self, descriptor):
+        return self._get_segment(descriptor.block_id).restore(descriptor)
+
+    def remove(self, block_id):
+        return self._get_segment(block_id).remove(block_id)
+
+    def admits(self, block_id, block_size):
+        return self._get_segment(block_id).admits(block_id, block_size)
+
+    def record(self, block_id):
+        self._get_segment(block_id).record(block_id)
+
+    def get_descriptor(self, block_id):
+        # Lock-free, as is_object_in_cache
+        return self._get_segment(block_id).descriptors_dict.get(block_id)
+
+    @property
+    def descriptors_dict(self):
+        descriptors_dict = {}
+        for segment in self.segments:
+            descriptors_dict.update(segment.descriptors_dict)
+        return descriptors_dict
+
+    @property
+    def descriptors(self):
+        descriptors = []
+        for segment in self.segments:
+            with segment.semaphore:
+                descriptors.extend(segment.descriptors)
+        return descriptors
+
+    @property
+    def get_hits(self):
+        return sum(segment.get_hits for segment in self.segments)
+
+    @property
+    def put_hits(self):
+        return sum(segment.put_hits for segment in self.segments)
+
+    @property
+    def misses(self):
+        return sum(segment.misses for segment in self.segments)
+
+    @property
+    def evictions(self):
+        return sum(segment.evictions for segment in self.segments)
+
+    @property
+    def rejections(self):
+        return sum(segment.rejections for segment in self.segments)
+
+    @property
+    def reads(self):
+        return sum(segment.reads for segment in self.segments)
+
+    @property
+    def writes(self):
+        return sum(segment.writes for segment in self.segments)
+
+    @property
+    def cache_size_bytes(self):
+        return sum(segment.cache_size_bytes for segment in self.segments)
+
+    @property
+    def lock_wait(self):
+        return sum(segment.lock_wait for segment in self.segments)
 
     def write_statistics(self):
         if ENABLE_CACHE:
@@ -278,18 +1347,800 @@ class BlockCache(object):
         print "CACHE PUT HITS: ", self.put_hits
         print "CACHE MISSES: ", self.misses
         print "CACHE EVICTIONS: ", self.evictions
+        print "CACHE REJECTIONS: ", self.rejections
         print "CACHE READS: ", self.reads
         print "CACHE WRITES: ", self.writes
         print "CACHE SIZE: ", self.cache_size_bytes
+        print "CACHE MAX SIZE: ", self.cache_max_size
+        print "CACHE LOCK WAIT: ", self.lock_wait
 
         for descriptor in self.descriptors:
             print "Object: ", descriptor.block_id, descriptor.last_access, descriptor.get_hits, descriptor.put_hits, descriptor.num_accesses, descriptor.size
 
 
+class BlockLayout(object):
+    """
+    Object cached by fixed-size blocks. The blocks are keyed by object ID,
+    etag and block index, so blocks of different versions are never mixed,
+    and are evicted independently.
+    """
+
+    def __init__(self, object_id, size, etag, storage_policy_id, content_type, block_size):
+        self.object_id = object_id
+        self.size = size
+        self.etag = etag
+        self.storage_policy_id = storage_policy_id
+        self.content_type = content_type
+        self.block_size = block_size
+        self.validated_at = time.time()
+
+    @property
+    def block_count(self):
+        return (self.size + self.block_size - 1) // self.block_size
+
+    def block_id(self, index):
+        return hashlib.md5(self.object_id + self.etag + str(index)).hexdigest()
+
+    def block_range(self, index):
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.size)
+
+
+class MemoryTier(object):
+    """
+    Byte-bounded RAM copy of small hot objects, kept in front of the disk
+    tier. Objects are promoted once they reach RAM_PROMOTION_HITS GET hits,
+    and the resident objects with fewer GET hits are demoted to make room.
+    The disk copy is always kept, so demoting only drops the bytes.
+    """
+
+    def __init__(self, max_size, object_max_size):
+        self.max_size = max_size
+        self.object_max_size = object_max_size
+        # block_id -> (descriptor, data)
+        self.objects = {}
+        self.size_bytes = 0
+        # Lower bound of the GET hits of the coldest resident object
+        self.min_resident_hits = 0
+        self.lock = Lock()
+
+    def get(self, block_id):
+        entry = self.objects.get(block_id)
+        if entry:
+            return entry[1]
+        return None
+
+    def is_promotable(self, descriptor):
+        return descriptor.size <= self.object_max_size and \
+            descriptor.get_hits >= RAM_PROMOTION_HITS and \
+            (self.size_bytes + descriptor.size <= self.max_size or
+             descriptor.get_hits > self.min_resident_hits)
+
+    def promote(self, descriptor, data):
+        with self.lock:
+            if descriptor.block_id in self.objects or len(data) > self.max_size:
+                return False
+            while self.size_bytes + len(data) > self.max_size:
+                coldest = min(self.objects.itervalues(), key=lambda entry: entry[0].get_hits)[0]
+                self.min_resident_hits = coldest.get_hits
+                if coldest.get_hits >= descriptor.get_hits:
+                    return False
+                self._demote(coldest.block_id)
+            self.objects[descriptor.block_id] = (descriptor, data)
+            self.size_bytes += len(data)
+            return True
+
+    def demote(self, block_id):
+        if block_id in self.objects:
+            with self.lock:
+                self._demote(block_id)
+
+    def _demote(self, block_id):
+        entry = self.objects.pop(block_id, None)
+        if entry:
+            self.size_bytes -= len(entry[1])
+            self.min_resident_hits = 0
+
+
+class CacheFill(object):
+    """
+    Population of the cache with one object. The chunks received from the
+    client or the backend are handed to the CacheWriter, which writes them
+    to a temporary file. The file only gets its final name once the whole
+    Content-Length has been written and the etag verified, so a partially
+    written object is never visible.
+    """
+
+    def __init__(self, writer, cache_path, object_id, size, etag, storage_policy_id, on_publish):
+        self.writer = writer
+        self.object_id = object_id
+        self.path = os.path.join(cache_path, object_id)
+        self.tmp_path = self.path + '.' + uuid.uuid4().hex + '.tmp'
+        self.created_at = time.time()
+        self.size = size
+        self.etag = etag
+        self.storage_policy_id = storage_policy_id
+        self.on_publish = on_publish
+        # Called once the fill has been published or discarded
+        self.on_done = None
+        # Set when the object is modified while being cached
+        self.cancelled = False
+        # Set when caching a block of a large object
+        self.layout = None
+        self.block_index = None
+
+        # Data path side
+        self.bytes_received = 0
+        self.ended = False
+        # Set while the publication waits for the backend to store the object
+        self.held = False
+        self.finished = False
+
+        # CacheWriter side
+        self.fd = None
+        self.md5 = hashlib.md5()
+        self.bytes_written = 0
+        self.failed = False
+        self.state = FILL_WRITING
+        # Notifies the requests streaming from this fill
+        self.progress = Condition()
+
+    def write(self, chunk):
+        if self.ended:
+            return
+        if not chunk:
+            self.close()
+            return
+        self.bytes_received += len(chunk)
+        if self.bytes_received > self.size or not self.writer.submit(self, chunk):
+            # The cache cannot keep up: drop this fill rather than block the client
+            self.ended = True
+            self._finish(FILL_ABORT)
+        elif self.bytes_received == self.size:
+            # Readers of wsgi.input stop at Content-Length without reaching EOF
+            self.close()
+
+    def close(self):
+        if self.ended:
+            return
+        self.ended = True
+        if not self.held:
+            self._finish(FILL_END if self.bytes_received == self.size else FILL_ABORT)
+
+    def hold(self):
+        """
+        Defers the publication of the fill until release().
+        """
+        self.held = True
+
+    def release(self, publish):
+        self.held = False
+        if not publish:
+            self.ended = True
+            self._finish(FILL_ABORT)
+        elif self.ended:
+            self._finish(FILL_END if self.bytes_received == self.size else FILL_ABORT)
+
+    def _finish(self, item):
+        if not self.finished:
+            self.finished = True
+            self.writer.submit(self, item)
+
+    def process(self, item):
+        """
+        Runs in the CacheWriter thread.
+        """
+        if self.failed:
+            return
+        try:
+            if item is FILL_END:
+                self._publish()
+            elif item is FILL_ABORT:
+                self._discard()
+            else:
+                self._append(item)
+        except (IOError, OSError):
+            self.failed = True
+            self._discard()
+            raise
+
+    def _append(self, chunk):
+        if self.fd is None:
+            self.fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        tpool.execute(os.write, self.fd, chunk)
+        self.md5.update(chunk)
+        with self.progress:
+            self.bytes_written += len(chunk)
+            self.progress.notify_all()
+
+    def _publish(self):
+        # The etag of a block's object cannot be verified against the block alone
+        etag = self.etag.strip('"') if self.layout is None else None
+        if self.cancelled or self.bytes_written != self.size or (etag and etag != self.md5.hexdigest()):
+            self._discard()
+            return
+        if not self.etag and self.layout is None:
+            # Known from now on to revalidate the cached object
+            self.etag = self.md5.hexdigest()
+        if self.fd is None:
+            # Empty object
+            self.fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        tpool.execute(os.fsync, self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.rename(self.tmp_path, self.path)
+        # The fill may have been cancelled during the fsync: on_publish checks it again
+        if not self.on_publish(self):
+            os.remove(self.path)
+        self._set_state(FILL_PUBLISHED)
+
+    def _discard(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self._set_state(FILL_DISCARDED)
+
+    def _set_state(self, state):
+        with self.progress:
+            self.state = state
+            self.progress.notify_all()
+        if self.on_done:
+            self.on_done()
+
+
+class BlockFillWriter(object):
+    """
+    Splits the body of an object cached by blocks into one CacheFill per
+    block. Blocks already cached or being cached elsewhere are skipped.
+    """
+
+    def __init__(self, layout, create_fill):
+        self.layout = layout
+        self.create_fill = create_fill
+        self.offset = 0
+        self.index = None
+        self.fill = None
+        self.held = False
+        self.fills = []
+
+    def write(self, chunk):
+        while chunk and self.offset < self.layout.size:
+            index = self.offset // self.layout.block_size
+            if index != self.index:
+                if self.fill:
+                    self.fill.close()
+                self.index = index
+                self.fill = self.create_fill(self.layout, index)
+                if self.fill and self.held:
+                    self.fill.hold()
+                    self.fills.append(self.fill)
+            block_stop = self.layout.block_range(index)[1]
+            part = chunk[:block_stop - self.offset]
+            if self.fill:
+                self.fill.write(part)
+            self.offset += len(part)
+            chunk = chunk[len(part):]
+
+    def close(self):
+        if self.fill:
+            self.fill.close()
+
+    def hold(self):
+        self.held = True
+
+    def release(self, publish):
+        self.held = False
+        for fill in self.fills:
+            fill.release(publish)
+        self.fills = []
+
+
+class CacheFlight(object):
+    """
+    Cache miss being fetched from the backend. Concurrent GETs of the same
+    object wait until its response headers are known and then stream it
+    from the CacheFill of the first request, if any.
+    """
+
+    def __init__(self):
+        self.ready = Event()
+        self.fill = None
+        self.headers = None
+        self.cancelled = False
+
+    def start(self, fill, headers):
+        if self.ready.is_set():
+            return
+        self.fill = fill
+        self.headers = headers
+        if fill and self.cancelled:
+            fill.cancelled = True
+        self.ready.set()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.fill:
+            self.fill.cancelled = True
+
+
+class FillFollowerIter(object):
+    """
+    Streams an object from the file of an in-flight CacheFill as the
+    CacheWriter writes it. If the fill is discarded before the whole object
+    has been read, the rest is requested to the backend through resume.
+    """
+
+    def __init__(self, fill, resume, timeout=FLIGHT_TIMEOUT):
+        self.fill = fill
+        self.resume = resume
+        self.timeout = timeout
+        self.offset = 0
+        self.fd = None
+        self.backend_iter = None
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.backend_iter is not None:
+            return self.backend_iter.next()
+        if self.offset >= self.fill.size:
+            self.close()
+            raise StopIteration('Stopped iterator ex')
+
+        fill = self.fill
+        with fill.progress:
+            if self.offset >= fill.bytes_written and fill.state == FILL_WRITING:
+                fill.progress.wait(self.timeout)
+            bytes_written = fill.bytes_written
+
+        if self.offset < bytes_written:
+            chunk = self._read(min(CHUNK_SIZE, bytes_written - self.offset))
+            if chunk:
+                self.offset += len(chunk)
+                return chunk
+
+        # Fill discarded, stalled or already evicted: go on from the backend
+        self._close_fd()
+        self.backend_iter = self.resume(self.offset)
+        return self.backend_iter.next()
+
+    def _read(self, size):
+        if self.fd is None:
+            for path in (self.fill.tmp_path, self.fill.path):
+                try:
+                    self.fd = os.open(path, os.O_RDONLY)
+                    os.lseek(self.fd, self.offset, os.SEEK_SET)
+                    break
+                except OSError:
+                    continue
+            else:
+                return None
+        return os.read(self.fd, size)
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        if self.closed:
+            return
+        self._close_fd()
+        if self.backend_iter is not None and hasattr(self.backend_iter, 'close'):
+            self.backend_iter.close()
+        self.closed = True
+
+    def __del__(self):
+        self.close()
+
+
+class CacheWriter(object):
+    """
+    Write-behind queue of the cache fills, drained by a single thread so
+    that the client data path never waits for the cache disk. The queued
+    bytes are bounded: chunks that do not fit are refused. Under eventlet
+    that thread is a greenthread, so the writes and fsyncs themselves run
+    in the native threads of eventlet.tpool not to block the hub.
+    """
+
+    def __init__(self, logger, max_pending_bytes):
+        self.logger = logger
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.writer_thread = None
+
+    def start(self):
+        self.writer_thread = Thread(target=self.run)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def submit(self, fill, item):
+        if item is not FILL_END and item is not FILL_ABORT:
+            with self.lock:
+                if self.pending_bytes + len(item) > self.max_pending_bytes:
+                    return False
+                self.pending_bytes += len(item)
+        self.queue.put((fill, item))
+        return True
+
+    def run(self):
+        while True:
+            fill, item = self.queue.get()
+            if item is not FILL_END and item is not FILL_ABORT:
+                with self.lock:
+                    self.pending_bytes -= len(item)
+            try:
+                fill.process(item)
+            except Exception as e:
+                self.logger.error('Cache Filter - Error writing object ' + fill.object_id +
+                                  ' in cache: ' + str(e))
+
+
+class InvalidationBus(object):
+    """
+    Propagates the invalidations of this proxy to the other ones, and
+    applies theirs. Invalidations are coalesced by object ID and sent in
+    batches, so a burst of writes does not flood the bus.
+    """
+
+    def __init__(self, logger, transport, on_invalidate, batch_interval=INVALIDATION_BATCH_INTERVAL):
+        self.logger = logger
+        self.transport = transport
+        self.on_invalidate = on_invalidate
+        self.batch_interval = batch_interval
+        # Set by start() in every proxy worker, which has its own cache
+        self.node_id = None
+        self.pending = set()
+        self.lock = Lock()
+        self.sender = None
+
+    def start(self):
+        self.node_id = uuid.uuid4().hex
+        self.transport.subscribe(self._receive)
+
+    def publish(self, object_id):
+        with self.lock:
+            self.pending.add(object_id)
+            if self.sender is None:
+                self.sender = Thread(target=self.run)
+                self.sender.daemon = True
+                self.sender.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.batch_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            object_ids = list(self.pending)
+            self.pending = set()
+        for batch_start in range(0, len(object_ids), INVALIDATION_BATCH_MAX):
+            message = json.dumps({'origin': self.node_id,
+                                  'objects': object_ids[batch_start:batch_start + INVALIDATION_BATCH_MAX]})
+            try:
+                self.transport.publish(message)
+            except Exception:
+                self.logger.exception('Cache Filter - Unable to publish cache invalidations')
+
+    def _receive(self, message):
+        try:
+            message = json.loads(message)
+        except ValueError:
+            return
+        if message.get('origin') == self.node_id:
+            return
+        for object_id in message.get('objects', []):
+            try:
+                self.on_invalidate(str(object_id))
+            except Exception:
+                self.logger.exception('Cache Filter - Unable to invalidate object ' + str(object_id))
+
+
+class LocalInvalidationTransport(object):
+    """
+    In-process invalidation transport, shared by all the caches of the
+    process. Used for testing.
+    """
+
+    subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, message):
+        for callback in list(self.subscribers):
+            callback(message)
+
+
+class RabbitInvalidationTransport(object):
+    """
+    Invalidation transport over RabbitMQ. Every proxy worker consumes from
+    its own exclusive queue bound to the invalidation routing key, and
+    reconnects in the background when the connection is lost.
+    """
+
+    def __init__(self, logger, host, port, user, password, exchange=INVALIDATION_EXCHANGE,
+                 routing_key=INVALIDATION_ROUTING_KEY):
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.exchange = exchange
+        self.routing_key = routing_key
+        # Only used by the InvalidationBus sender thread
+        self.publish_channel = None
+
+    def _connect(self):
+        import pika
+        credentials = pika.PlainCredentials(self.user, self.password)
+        parameters = pika.ConnectionParameters(host=self.host, port=self.port, credentials=credentials)
+        return pika.BlockingConnection(parameters)
+
+    def subscribe(self, callback):
+        # Connecting is left to the consumer thread, not to block the proxy start
+        consumer = Thread(target=self._consume, args=(callback,))
+        consumer.daemon = True
+        consumer.start()
+
+    def _consume(self, callback):
+        retry = INVALIDATION_RETRY_MIN
+        while True:
+            try:
+                channel = self._connect().channel()
+                queue = channel.queue_declare(exclusive=True).method.queue
+                channel.queue_bind(exchange=self.exchange, routing_key=self.routing_key, queue=queue)
+                channel.basic_consume(lambda ch, method, properties, body: callback(body),
+                                      queue=queue, no_ack=True)
+                retry = INVALIDATION_RETRY_MIN
+                channel.start_consuming()
+            except Exception as e:
+                # Invalidations sent while disconnected are lost
+                self.logger.error('Cache Filter - Invalidation consumer failed, retrying in ' +
+                                  str(retry) + 's: ' + str(e))
+                time.sleep(retry)
+                retry = min(retry * 2, INVALIDATION_RETRY_MAX)
+
+    def publish(self, message):
+        if self.publish_channel is None:
+            self.publish_channel = self._connect().channel()
+        try:
+            self.publish_channel.basic_publish(exchange=self.exchange, routing_key=self.routing_key,
+                                               body=message)
+        except Exception:
+            # Reconnect on the next batch
+            self.publish_channel = None
+            raise
+
+
+class CacheMetrics(object):
+    """
+    Counters and latency histograms of the cache, rendered in the
+    Prometheus text format. Every update is also sent to statsd through
+    the Swift logger, when statsd is configured.
+    """
+
+    def __init__(self, logger, buckets=METRICS_LATENCY_BUCKETS):
+        self.logger = logger
+        self.buckets = buckets
+        self.counters = {}
+        # name -> [observations per bucket, sum, count]
+        self.histograms = {}
+        self.lock = Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.logger.update_stats(name, value)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self.histograms[name]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+        # statsd timers are in milliseconds
+        self.logger.timing(name.replace('_seconds', ''), seconds * 1000)
+
+    def render(self, gauges=None, counters=None):
+        lines = []
+        for name, value in sorted((gauges or {}).items()):
+            lines.append('# TYPE ' + name + ' gauge')
+            lines.append(name + ' ' + str(value))
+        with self.lock:
+            all_counters = dict(self.counters)
+            histograms = [(name, list(histogram[0]), histogram[1], histogram[2])
+                          for name, histogram in self.histograms.items()]
+        all_counters.update(counters or {})
+        for name, value in sorted(all_counters.items()):
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + ' ' + str(value))
+        for name, observations, total, count in sorted(histograms):
+            lines.append('# TYPE ' + name + ' histogram')
+            cumulative = 0
+            for bound, observed in zip(self.buckets, observations):
+                cumulative += observed
+                lines.append(name + '_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+            lines.append(name + '_bucket{le="+Inf"} ' + str(count))
+            lines.append(name + '_sum ' + str(total))
+            lines.append(name + '_count ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+
+class CacheIndex(object):
+    """
+    On-disk index of the cached objects: a snapshot of all the descriptors
+    plus an append-only journal of the PUTs and removals made since then.
+    Both files contain one JSON record per line.
+    """
+
+    def __init__(self, cache_path):
+        self.snapshot_path = os.path.join(cache_path, CACHE_INDEX_SNAPSHOT)
+        self.journal_path = os.path.join(cache_path, CACHE_INDEX_JOURNAL)
+        # Removed only once the new snapshot is written
+        self.rotated_journal_path = os.path.join(cache_path, CACHE_INDEX_ROTATED_JOURNAL)
+        self.journal_fd = None
+        self.journal_records = 0
+        self.last_snapshot = time.time()
+        self.snapshot_running = False
+        self.lock = Lock()
+
+    def load(self):
+        descriptors = {}
+        for record in self._read_records(self.snapshot_path):
+            descriptor = self._to_descriptor(record)
+            descriptors[descriptor.block_id] = descriptor
+        records = itertools.chain(self._read_records(self.rotated_journal_path),
+                                  self._read_records(self.journal_path))
+        for record in records:
+            if record['op'] == 'put':
+                descriptor = self._to_descriptor(record)
+                if descriptor.block_id in descriptors:
+                    previous = descriptors[descriptor.block_id]
+                    descriptor.get_hits = previous.get_hits
+                    descriptor.put_hits = previous.put_hits + 1
+                    descriptor.num_accesses = previous.num_accesses + 1
+                descriptors[descriptor.block_id] = descriptor
+            elif record['op'] == 'remove':
+                descriptors.pop(record['id'], None)
+        return descriptors
+
+    def _read_records(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as index_file:
+            for line in index_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Torn record written during a crash
+                    continue
+
+    def _to_descriptor(self, record):
+        descriptor = CacheObjectDescriptor(str(record['id']), record['size'], str(record['etag']),
+                                           str(record['policy']))
+        descriptor.last_access = record.get('last_access', descriptor.last_access)
+        descriptor.get_hits = record.get('get_hits', 0)
+        descriptor.put_hits = record.get('put_hits', 0)
+        descriptor.num_accesses = record.get('num_accesses', 0)
+        # The object may have been modified while the cache was not running
+        descriptor.validated_at = 0
+        if 'object' in record:
+            descriptor.layout = BlockLayout(str(record['object']), record['object_size'], descriptor.etag,
+                                            descriptor.storage_policy_id, str(record['content_type']),
+                                            record['block_size'])
+            descriptor.layout.validated_at = 0
+            descriptor.block_index = record['index']
+        return descriptor
+
+    def _to_record(self, descriptor):
+        record = {'id': descriptor.block_id, 'size': descriptor.size,
+                  'etag': descriptor.etag, 'policy': descriptor.storage_policy_id,
+                  'last_access': descriptor.last_access, 'get_hits': descriptor.get_hits,
+                  'put_hits': descriptor.put_hits, 'num_accesses': descriptor.num_accesses}
+        self._add_layout(record, descriptor.layout, descriptor.block_index)
+        return record
+
+    def _add_layout(self, record, layout, block_index):
+        if layout:
+            record.update({'object': layout.object_id, 'object_size': layout.size,
+                           'content_type': layout.content_type, 'block_size': layout.block_size,
+                           'index': block_index})
+
+    def record_put(self, block_id, size, etag, storage_policy_id, layout=None, block_index=None):
+        record = {'op': 'put', 'id': block_id, 'size': size, 'etag': etag,
+                  'policy': storage_policy_id, 'last_access': time.time()}
+        self._add_layout(record, layout, block_index)
+        self._append(record)
+
+    def record_remove(self, block_id):
+        self._append({'op': 'remove', 'id': block_id})
+
+    def _append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.journal_fd is None:
+                self.journal_fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            os.write(self.journal_fd, line)
+            self.journal_records += 1
+
+    def snapshot_due(self):
+        return not self.snapshot_running and \
+            (self.journal_records >= CACHE_INDEX_SNAPSHOT_RECORDS or
+             time.time() - self.last_snapshot >= CACHE_INDEX_SNAPSHOT_INTERVAL)
+
+    def snapshot_async(self, get_descriptors):
+        with self.lock:
+            if self.snapshot_running:
+                return
+            self.snapshot_running = True
+
+        def run():
+            try:
+                self.snapshot(get_descriptors)
+            finally:
+                self.snapshot_running = False
+
+        snapshot_thread = Thread(target=run)
+        snapshot_thread.daemon = True
+        snapshot_thread.start()
+
+    def snapshot(self, get_descriptors):
+        """
+        Writes all the descriptors to a new snapshot and atomically replaces
+        the previous one. The journal is rotated before the descriptors are
+        collected, so the records appended meanwhile are kept for replay.
+        """
+        with self.lock:
+            if self.journal_fd is not None:
+                os.close(self.journal_fd)
+                self.journal_fd = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.rotated_journal_path):
+                    # The previous snapshot did not complete: keep both journals for replay
+                    with open(self.journal_path, 'r') as journal, \
+                            open(self.rotated_journal_path, 'a') as rotated_journal:
+                        rotated_journal.writelines(journal)
+                    os.remove(self.journal_path)
+                else:
+                    os.rename(self.journal_path, self.rotated_journal_path)
+            self.journal_records = 0
+            self.last_snapshot = time.time()
+
+        tmp_path = self.snapshot_path + '.tmp'
+        records = [json.dumps(self._to_record(descriptor)) + '\n' for descriptor in get_descriptors()]
+        # In a native thread, not to block the eventlet hub
+        tpool.execute(self._write_snapshot, tmp_path, records)
+
+        os.rename(tmp_path, self.snapshot_path)
+        if os.path.exists(self.rotated_journal_path):
+            os.remove(self.rotated_journal_path)
+
+    def _write_snapshot(self, path, records):
+        with open(path, 'w') as snapshot_file:
+            snapshot_file.writelines(records)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+
 class DataIter(object):
     def __init__(self, obj_data, timeout, cached_object, filter_method):
         self.closed = False
         self.obj_data = obj_data
+        # Any iterable app_iter, such as a list or a SegmentedIterable
+        self.obj_iter = None if hasattr(obj_data, 'read') else iter(obj_data)
         self.timeout = timeout
         self.buf = b''
         self.cached_object = cached_object
@@ -305,7 +2156,7 @@ class DataIter(object):
                 if hasattr(self.obj_data, 'read'):
                     chunk = self.obj_data.read(size)
                 else:
-                    chunk = self.obj_data.next()
+                    chunk = self.obj_iter.next()
                 chunk = self.filter(self.cached_object, chunk)
         except Timeout:
             self.close()
@@ -318,7 +2169,12 @@ class DataIter(object):
 
     def next(self, size=CHUNK_SIZE):
         if len(self.buf) < size:
-            self.buf += self.read_with_timeout(size - len(self.buf))
+            try:
+                self.buf += self.read_with_timeout(size - len(self.buf))
+            except StopIteration:
+                # An iterable app_iter may yield chunks larger than size:
+                # return what is left of the last one before stopping
+                pass
             if self.buf == b'':
                 self.close()
                 raise StopIteration('Stopped iterator ex')
@@ -396,54 +2252,106 @@ class DataIter(object):
         self.close()
 
 
-class FdIter(DataIter):
-    def __init__(self, obj_data, timeout):
-        super(FdIter, self).__init__(obj_data, timeout, None, None)
+class MmapIter(object):
+    """
+    Cache hit iterator that memory-maps the cached file and yields slices of
+    the mapping, so chunks are copied once from the page cache instead of
+    being read into an intermediate buffer. The chunks are str, not buffers
+    of the mapping: eventlet.wsgi joins them and only accepts str.
+    """
+
+    def __init__(self, fd, chunk_size=CHUNK_SIZE):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.offset = 0
         self.closed = False
-        self.obj_data = obj_data
-        self.timeout = timeout
-        self.buf = b''
+        self.size = os.fstat(fd).st_size
+        # Empty files cannot be mapped
+        self.mmap = mmap.mmap(fd, 0, prot=mmap.PROT_READ) if self.size else None
 
-    def read_with_timeout(self, size):
-        try:
-            with Timeout(self.timeout):
-                chunk = os.read(self.obj_data, size)
-        except Timeout:
-            self.close()
-            raise
-        except Exception:
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.read(self.chunk_size)
+        if not data:
             self.close()
-            raise
-        return chunk
+            raise StopIteration('Stopped iterator ex')
+        return data
 
-    def next(self, size=CHUNK_SIZE):
-        if len(self.buf) < size:
-            r, _, _ = select.select([self.obj_data], [], [], self.timeout)
-            if len(r) == 0:
-                self.close()
+    def read(self, size=-1):
+        if self.closed or self.offset >= self.size:
+            return b''
+        end = self.size if size < 0 else min(self.offset + size, self.size)
+        data = self.mmap[self.offset:end]
+        self.offset = end
+        return data
 
-            if self.obj_data in r:
-                self.buf += self.read_with_timeout(size - len(self.buf))
-                if self.buf == b'':
-                    self.close()
-                    raise StopIteration('Stopped iterator ex')
-            else:
-                raise StopIteration('Stopped iterator ex')
+    def app_iter_range(self, start, stop):
+        if stop is None or stop > self.size:
+            stop = self.size
+        return self._closing_iter(self._range_iter(start, stop))
 
-        if len(self.buf) > size:
-            data = self.buf[:size]
-            self.buf = self.buf[size:]
-        else:
-            data = self.buf
-            self.buf = b''
-        return data
+    def app_iter_ranges(self, ranges, content_type, boundary, size):
+        return self._closing_iter(multi_range_iterator(ranges, content_type, boundary, size,
+                                                       self._range_iter))
+
+    def _range_iter(self, start, stop):
+        offset = start
+        while offset < stop:
+            end = min(offset + self.chunk_size, stop)
+            yield self.mmap[offset:end]
+            offset = end
+
+    def _closing_iter(self, iterator):
+        try:
+            for chunk in iterator:
+                yield chunk
+        finally:
+            self.close()
 
     def close(self):
         if self.closed:
             return
-        os.close(self.obj_data)
+        if self.mmap:
+            self.mmap.close()
+        os.close(self.fd)
         self.closed = True
 
+    def __del__(self):
+        self.close()
+
+
+class BlockAssemblyIter(object):
+    """
+    Body of an object cached by blocks, assembled block by block. Ranged
+    requests only read the blocks they overlap.
+    """
+
+    def __init__(self, layout, read_block):
+        self.layout = layout
+        # read_block(index, start, stop) yields the bytes [start, stop) of a block
+        self.read_block = read_block
+
+    def __iter__(self):
+        return self._range_iter(0, self.layout.size)
+
+    def app_iter_range(self, start, stop):
+        if stop is None or stop > self.layout.size:
+            stop = self.layout.size
+        return self._range_iter(start, stop)
+
+    def app_iter_ranges(self, ranges, content_type, boundary, size):
+        return multi_range_iterator(ranges, content_type, boundary, size, self._range_iter)
+
+    def _range_iter(self, start, stop):
+        block_size = self.layout.block_size
+        for index in range(start // block_size, (stop + block_size - 1) // block_size):
+            block_start, block_stop = self.layout.block_range(index)
+            for chunk in self.read_block(index, max(start, block_start) - block_start,
+                                         min(stop, block_stop) - block_start):
+                yield chunk
+
 
 def filter_factory(global_conf, **local_conf):
     conf = global_conf.copy()
@@ -1,10 +1,16 @@
+from collections import OrderedDict
 import hashlib
+import urllib
+import math
+import re
+import json
 import time
+import uuid
 import os
 import select
 
 from crystal_filter_middleware.filters.abstract_filter import AbstractFilter
-from eventlet import Timeout
+from eventlet import GreenPool, Timeout, sleep
 from swift.common.internal_client import InternalClient
 from swift.common.swob import Request, Response
 from threading import Semaphore, Lock, Thread
@@ -20,6 +26,50 @@ CHUNK_SIZE = 65536
 PROXY_PATH = '/etc/swift/local-proxy-server-prefetch.conf'
 ACCEPTABLE_STATUS = [200]
 USER_AGENT = 'Crystal Filter Internal Client'
+# Objects fetched at the same time when prefetching
+DEFAULT_PREFETCH_CONCURRENCY = 8
+# Attempts of each object after the first one, and first backoff in seconds
+DEFAULT_PREFETCH_RETRIES = 3
+PREFETCH_RETRY_BACKOFF = 0.5
+# Prefetch bandwidth (MB/s) and requests per second caps, 0 for no limit
+DEFAULT_PREFETCH_MAX_BANDWIDTH = 0
+DEFAULT_PREFETCH_MAX_IOPS = 0
+# Seconds between prefetch progress reports
+PREFETCH_PROGRESS_INTERVAL = 10
+MB = 1024 * 1024.
+# Seconds after which an access counts half when ranking objects to warm up
+WARMUP_HALF_LIFE = 3600
+# Seconds between cache snapshot exports
+SNAPSHOT_EXPORT_INTERVAL = 300
+# Priority of the cached objects not belonging to any prefetch target
+DEFAULT_TARGET_PRIORITY = 0
+# Seconds between passes of the prefetch scheduler
+DEFAULT_PREFETCH_INTERVAL = 60
+# Objects listed per target and pass; the next pass resumes from there
+LISTING_PAGE_LIMIT = 10000
+# Foreground GETs per second above which prefetching backs off
+DEFAULT_PREFETCH_MAX_LOAD = 100
+MAX_PREFETCH_BACKOFF = 600
+# Fraction of the max load under which the node is idle
+IDLE_LOAD_FRACTION = 0.1
+# Seconds over which the foreground load is averaged
+LOAD_WINDOW = 10
+# Evicted objects with hits remembered to refill them later
+MAX_EVICTED_HISTORY = 1000
+# Predictive prefetching: minimum confidence of a prediction to prefetch it
+DEFAULT_PREDICTION_THRESHOLD = 0.5
+# Objects predicted ahead of a sequential run of object names
+SEQUENTIAL_LOOKAHEAD = 2
+SEQUENTIAL_NAME = re.compile(r'^(.*?)(\d+)(\D*)$')
+# Bounds of the Markov table of transitions between objects
+MAX_PREDICTOR_STATES = 10000
+MAX_STATE_TRANSITIONS = 8
+MIN_TRANSITION_OBSERVATIONS = 2
+# Accesses to the same prefix within the window that start a burst
+PREFIX_BURST_ACCESSES = 4
+PREFIX_BURST_WINDOW = 10
+# Most objects listed for a predicted prefix
+PREFIX_LISTING_LIMIT = 1000
 
 
 class Singleton(type):
@@ -53,14 +103,48 @@ class PrefetchControl(AbstractFilter):
         self.cache_path = self._get_cache_path()
         self.eviction_policy = self._get_eviction_policy()
         self.tenant_id, self.container = self._get_tenant_container()
+        self.targets = self._get_prefetch_targets()
+        self.warmup_log, self.warmup_snapshot = self._get_warmup_sources()
+        self.prefetch_concurrency = self._get_prefetch_concurrency()
+        self.prefetch_retries = self._get_prefetch_retries()
+        self.prefetch_max_bandwidth, self.prefetch_max_iops = self._get_prefetch_limits()
+        # Shared by all the downloaders, so that the caps apply to prefetching overall
+        self.prefetch_bandwidth = RateLimiter(self.prefetch_max_bandwidth * MB) if self.prefetch_max_bandwidth else None
+        self.prefetch_iops = RateLimiter(self.prefetch_max_iops) if self.prefetch_max_iops else None
+        self.snapshot_export_path = self._get_snapshot_export_path()
+        self.prediction_threshold, self.prediction_budget = self._get_prediction_params()
+        self.prefetch_interval, self.prefetch_max_load = self._get_scheduler_params()
 
         self.cache = BlockCache(self.cache_max_size, self.eviction_policy)
+        # Created once here, so that hits do not check it on every request
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+
+        # Learns the access patterns of the intercepted GETs, if enabled
+        self.predictor = AccessPredictor() if self._get_predictive_prefetch() else None
+        self.prediction_downloader = None
+        self.prediction_client = None
+        # Clients of the scheduler, built once as they parse the proxy config
+        self.listing_client = None
+        self.download_client = None
+        # Predicted objects being prefetched
+        self.predicted = set()
+        # Rate of the intercepted GETs
+        self.foreground = LoadMeter()
+        # Listing marker of each target for the next scheduler pass
+        self.listing_markers = {}
 
         # Fill cache with prefetched files
         self.prefetch_thread = Thread(target=self.init_prefetching)
         self.prefetch_thread.daemon = True
         self.prefetch_thread.start()
 
+        if self.snapshot_export_path:
+            # Lets other nodes warm up with the objects hot in this one
+            self.export_thread = Thread(target=self.export_snapshots)
+            self.export_thread.daemon = True
+            self.export_thread.start()
+
     def _get_cache_max_size(self):
         cache_max_size = DEFAULT_CACHE_MAX_SIZE
         if self.filter_conf['params']:
@@ -92,32 +176,246 @@ class PrefetchControl(AbstractFilter):
                 container = self.filter_conf['params']['container']
         return tenant_id, container
 
+    def _get_prefetch_targets(self):
+        """
+        Parses prefetch_targets, a JSON list of {"account", "container",
+        "prefix", "budget", "priority"} objects. Without it, the whole
+        tenant_id/container is the only target. Targets without a budget
+        share the cache space the other budgets leave.
+        """
+        targets = []
+        if self.filter_conf['params'] and 'prefetch_targets' in self.filter_conf['params']:
+            targets_conf = self.filter_conf['params']['prefetch_targets']
+            if isinstance(targets_conf, basestring):
+                targets_conf = json.loads(targets_conf)
+            for target in targets_conf:
+                budget = int(target['budget']) if target.get('budget') is not None else None
+                targets.append(PrefetchTarget(str(target['account']), str(target['container']),
+                                              str(target.get('prefix', '')), budget,
+                                              int(target.get('priority', DEFAULT_TARGET_PRIORITY))))
+        else:
+            targets.append(PrefetchTarget('AUTH_' + self.tenant_id, self.container, '', None,
+                                          DEFAULT_TARGET_PRIORITY))
+
+        unassigned = [target for target in targets if target.budget is None]
+        if unassigned:
+            assigned = sum(target.budget for target in targets if target.budget is not None)
+            for target in unassigned:
+                target.budget = max(self.cache_max_size - assigned, 0) // len(unassigned)
+        # Most important targets first
+        return sorted(targets, key=lambda target: target.priority, reverse=True)
+
+    def _get_target(self, object_path):
+        for target in self.targets:
+            if target.matches(object_path):
+                return target
+        return None
+
+    def _get_warmup_sources(self):
+        warmup_log = None
+        warmup_snapshot = None
+        if self.filter_conf['params']:
+            if 'warmup_log' in self.filter_conf['params']:
+                warmup_log = self.filter_conf['params']['warmup_log']
+            if 'warmup_snapshot' in self.filter_conf['params']:
+                warmup_snapshot = self.filter_conf['params']['warmup_snapshot']
+        return warmup_log, warmup_snapshot
+
+    def _get_prefetch_concurrency(self):
+        prefetch_concurrency = DEFAULT_PREFETCH_CONCURRENCY
+        if self.filter_conf['params']:
+            if 'prefetch_concurrency' in self.filter_conf['params']:
+                prefetch_concurrency = int(self.filter_conf['params']['prefetch_concurrency'])
+        return prefetch_concurrency
+
+    def _get_prefetch_retries(self):
+        prefetch_retries = DEFAULT_PREFETCH_RETRIES
+        if self.filter_conf['params']:
+            if 'prefetch_retries' in self.filter_conf['params']:
+                prefetch_retries = int(self.filter_conf['params']['prefetch_retries'])
+        return prefetch_retries
+
+    def _get_prefetch_limits(self):
+        max_bandwidth = DEFAULT_PREFETCH_MAX_BANDWIDTH
+        max_iops = DEFAULT_PREFETCH_MAX_IOPS
+        if self.filter_conf['params']:
+            if 'prefetch_max_bandwidth' in self.filter_conf['params']:
+                max_bandwidth = float(self.filter_conf['params']['prefetch_max_bandwidth'])
+            if 'prefetch_max_iops' in self.filter_conf['params']:
+                max_iops = float(self.filter_conf['params']['prefetch_max_iops'])
+        return max_bandwidth, max_iops
+
+    def _get_snapshot_export_path(self):
+        snapshot_export_path = None
+        if self.filter_conf['params']:
+            if 'snapshot_export_path' in self.filter_conf['params']:
+                snapshot_export_path = self.filter_conf['params']['snapshot_export_path']
+        return snapshot_export_path
+
+    def _get_predictive_prefetch(self):
+        predictive_prefetch = False
+        if self.filter_conf['params']:
+            if 'predictive_prefetch' in self.filter_conf['params']:
+                predictive_prefetch = str(self.filter_conf['params']['predictive_prefetch']).lower() == 'true'
+        return predictive_prefetch
+
+    def _get_prediction_params(self):
+        prediction_threshold = DEFAULT_PREDICTION_THRESHOLD
+        # Largest predicted object, and bytes prefetched for each prefix burst
+        prediction_budget = self.cache_max_size // 4
+        if self.filter_conf['params']:
+            if 'prediction_threshold' in self.filter_conf['params']:
+                prediction_threshold = float(self.filter_conf['params']['prediction_threshold'])
+            if 'prediction_budget' in self.filter_conf['params']:
+                prediction_budget = int(self.filter_conf['params']['prediction_budget'])
+        return prediction_threshold, prediction_budget
+
+    def _get_scheduler_params(self):
+        prefetch_interval = DEFAULT_PREFETCH_INTERVAL
+        prefetch_max_load = DEFAULT_PREFETCH_MAX_LOAD
+        if self.filter_conf['params']:
+            if 'prefetch_interval' in self.filter_conf['params']:
+                prefetch_interval = int(self.filter_conf['params']['prefetch_interval'])
+            if 'prefetch_max_load' in self.filter_conf['params']:
+                prefetch_max_load = float(self.filter_conf['params']['prefetch_max_load'])
+        return prefetch_interval, prefetch_max_load
+
     def _get_object(self, req_resp, crystal_iter):
 
         if isinstance(req_resp, Request):
 
-            # Check if Object is in cache
-            if os.path.exists(self.cache_path):
-
-                object_path = req_resp.environ['PATH_INFO']
-                object_id = (hashlib.md5(object_path).hexdigest())
+            start = time.time()
+            object_path = req_resp.environ['PATH_INFO']
+            self.foreground.hit()
+            if self.predictor:
+                try:
+                    self._predict(object_path)
+                except Exception as e:
+                    # Predictions are only advisory: never fail the request
+                    self.logger.warning('Prefetch Filter - Unable to predict the accesses after ' +
+                                        object_path + ': ' + str(e))
+            object_id = (hashlib.md5(object_path).hexdigest())
 
-                object_id, object_size, object_etag, object_storage_policy_id = self.cache.access_cache("GET", object_id)
+            # Check if Object is in cache
+            object_id, object_size, object_etag, object_storage_policy_id = self.cache.access_cache("GET", object_id)
+            descriptor = self.cache.get_descriptor(object_id) if object_id else None
 
-                if object_id:
+            if descriptor:
+                data_iter = self._get_cached_object(req_resp, descriptor)
+                if data_iter is not None:
                     self.logger.info('Prefetch Filter - Object ' + object_path + ' found in cache')
-                    resp_headers = {}
-                    resp_headers['Content-Length'] = str(object_size)
-                    resp_headers['Etag'] = object_etag
+                    # Sent to statsd, when configured in the proxy
+                    self.logger.increment('prefetch_hits_total')
+                    self.logger.update_stats('prefetch_hit_bytes_total', object_size)
+                    self.logger.timing_since('prefetch_hit_latency', start)
+                    return data_iter
 
-                    cached_object_fd = os.open(os.path.join(self.cache_path, object_id), os.O_RDONLY)
-
-                    req_resp.response_headers = resp_headers
-                    req_resp.environ['HTTP_X_BACKEND_STORAGE_POLICY_INDEX'] = object_storage_policy_id
-                    return FdIter(cached_object_fd, 10)
+            self.logger.increment('prefetch_misses_total')
 
         return req_resp.environ['wsgi.input']
 
+    def _get_cached_object(self, req, descriptor):
+        """
+        Builds the whole response of a prefetch hit from the descriptor, so
+        that the object server is not contacted at all. Returns None if the
+        object was evicted meanwhile. The middleware only takes the
+        response headers from the filter, so conditional requests get the
+        whole object too.
+        """
+        resp_headers = {}
+        resp_headers['Etag'] = descriptor.etag
+        if descriptor.content_type:
+            resp_headers['Content-Type'] = descriptor.content_type
+        req.environ['HTTP_X_BACKEND_STORAGE_POLICY_INDEX'] = descriptor.storage_policy_id
+
+        try:
+            cached_object_fd = os.open(os.path.join(self.cache_path, descriptor.block_id), os.O_RDONLY)
+        except OSError:
+            return None
+        resp_headers['Content-Length'] = str(descriptor.size)
+        req.response_headers = resp_headers
+        return FdIter(cached_object_fd, 10)
+
+    def _predict(self, object_path):
+        for kind, target, confidence in self.predictor.record(object_path):
+            if confidence < self.prediction_threshold:
+                continue
+            if kind == 'object':
+                self._prefetch_predicted(target)
+            else:
+                container_path, prefix = target
+                self._prefetch_predicted(container_path + '/' + prefix, listing=True)
+
+    def _get_prediction_downloader(self):
+        if self.prediction_downloader is None:
+            # Predictions are not retried: the next object may just not exist
+            self.prediction_downloader = PrefetchDownloader(self.logger, self._prefetch_predicted_object,
+                                                            self.prefetch_concurrency, 0,
+                                                            self.prefetch_bandwidth, self.prefetch_iops)
+        return self.prediction_downloader
+
+    def _get_prediction_client(self):
+        """
+        Built by the first predicted download, not to delay the request that
+        triggered it. If the internal client cannot be built, predictive
+        prefetching is disabled instead of failing again on every request.
+        """
+        if self.prediction_client is None:
+            try:
+                self.prediction_client = InternalClient(PROXY_PATH, USER_AGENT, request_tries=1)
+            except Exception as e:
+                if self.predictor:
+                    self.predictor = None
+                    self.logger.error('Prefetch Filter - Predictive prefetching disabled, unable to create '
+                                      'its internal client: ' + str(e))
+                raise
+        return self.prediction_client
+
+    def _prefetch_predicted(self, object_path, listing=False):
+        """
+        Queues a predicted object, or the listing of a predicted prefix, in
+        the prediction downloader. Returns False if it is busy.
+        """
+        if object_path in self.predicted or self.cache.is_object_in_cache(hashlib.md5(object_path).hexdigest()):
+            return True
+        downloader = self._get_prediction_downloader()
+        self.predicted.add(object_path)
+        if not downloader.try_submit(object_path, listing):
+            # Prefetching is already busy, never delay the request
+            self.predicted.discard(object_path)
+            return False
+        return True
+
+    def _prefetch_predicted_object(self, object_path, throttle, listing=False):
+        try:
+            if listing:
+                return self._prefetch_predicted_prefix(object_path)
+            return self._prefetch_object(self._get_prediction_client(), object_path, throttle=throttle,
+                                         max_size=self.prediction_budget)
+        finally:
+            self.predicted.discard(object_path)
+
+    def _prefetch_predicted_prefix(self, prefix_path):
+        """
+        Queues the objects under a predicted prefix until spending the
+        prediction budget. Returns 0, as it fetches no data itself.
+        """
+        _, _, acc, container, prefix = prefix_path.split('/', 4)
+        container_path = '/v1/' + acc + '/' + container
+        budget = self.prediction_budget
+        listed = 0
+        for o in self._get_prediction_client().iter_objects(acc, container, prefix=prefix):
+            listed += 1
+            if budget <= 0 or listed > PREFIX_LISTING_LIMIT:
+                break
+            if int(o['bytes']) >= budget:
+                continue
+            if not self._prefetch_predicted(container_path + '/' + o['name']):
+                # The downloader is busy, the rest of the prefix is dropped
+                break
+            budget -= int(o['bytes'])
+        return 0
+
     def _filter_put(self, cached_object, chunk):
         cached_object.write(chunk)
         return chunk
@@ -125,47 +423,523 @@ class PrefetchControl(AbstractFilter):
     def init_prefetching(self):
         time.sleep(1)
 
-        account = 'AUTH_' + self.tenant_id
-        self.download(account, self.container, USER_AGENT)
-
-    def download(self, acc, container, u_agent, delay=0, request_tries=3):
-        self.logger.info('Prefetching objects with InternalClient with ' + str(delay) + ' seconds of delay.')
-        time.sleep(delay)
-        swift = InternalClient(PROXY_PATH, u_agent, request_tries=request_tries)
-        headers = {}
-
-        prefetch_list = []
-        bytes_count = 0
-        for o in swift.iter_objects(acc, container):
-            if bytes_count + int(o['bytes']) < self.cache_max_size:
-                prefetch_list.append(o['name'])
-                bytes_count += int(o['bytes'])
-            else:
+        if self.warmup_log or self.warmup_snapshot:
+            self.warm_up()
+        self.run_scheduler()
+
+    def run_scheduler(self):
+        """
+        Prefetches continuously: every prefetch_interval seconds the
+        configured containers are listed again to fetch the new and the
+        modified objects, and the evicted hot objects are refilled when
+        the node is idle. Passes are delayed with exponential backoff while
+        the foreground load is high.
+        """
+        backoff = 0
+        while True:
+            if self._overloaded():
+                backoff = min(backoff * 2 or self.prefetch_interval, MAX_PREFETCH_BACKOFF)
+                self.logger.info('Prefetch Filter - High foreground load, prefetching delayed ' +
+                                 str(backoff) + ' seconds')
+                time.sleep(backoff)
+                continue
+            backoff = 0
+            try:
+                self.prefetch_pass()
+            except Exception:
+                # Keep prefetching in the next pass
+                self.logger.exception('Prefetch Filter - Prefetch pass failed')
+            time.sleep(self.prefetch_interval)
+
+    def prefetch_pass(self):
+        if self.listing_client is None:
+            self.listing_client = InternalClient(PROXY_PATH, USER_AGENT, request_tries=3)
+        downloader = self._create_downloader(USER_AGENT)
+        usage = self._get_targets_usage()
+        for target in self.targets:
+            try:
+                self._sync_target(self.listing_client, downloader, target, usage.get(target, 0))
+            except Exception as e:
+                self.logger.warning('Prefetch Filter - Unable to list ' + target.path + ': ' + str(e))
+        if self.foreground.rate < self.prefetch_max_load * IDLE_LOAD_FRACTION:
+            self._refill_evicted(downloader)
+        downloader.wait()
+
+    def _overloaded(self):
+        return self.foreground.rate > self.prefetch_max_load
+
+    def _get_targets_usage(self):
+        # Cached bytes of every target
+        usage = {}
+        with self.cache.semaphore:
+            descriptors = self.cache.descriptors
+        for descriptor in descriptors:
+            target = self._get_target(descriptor.path) if descriptor.path else None
+            if target:
+                usage[target] = usage.get(target, 0) + descriptor.size
+        return usage
+
+    def _sync_target(self, swift, downloader, target, used_bytes):
+        """
+        Lists a page of the target from the marker of the previous pass
+        and prefetches the objects that are not cached and fit in the
+        target budget, and the cached objects whose etag has changed.
+        """
+        marker = self.listing_markers.get(target, '')
+        free_bytes = target.budget - used_bytes
+        listed = 0
+        for o in swift.iter_objects(target.account, target.container, marker=marker, prefix=target.prefix):
+            if self._overloaded():
+                break
+            marker = o['name']
+            listed += 1
+            object_path = '/v1/' + target.account + '/' + target.container + '/' + o['name']
+            descriptor = self.cache.get_descriptor(hashlib.md5(object_path).hexdigest())
+            if descriptor:
+                if descriptor.etag and descriptor.etag.strip('"') != o['hash']:
+                    self.logger.info('Prefetch Filter - Object ' + object_path + ' modified, prefetching it again')
+                    downloader.submit(object_path)
+            elif int(o['bytes']) < free_bytes:
+                downloader.submit(object_path)
+                free_bytes -= int(o['bytes'])
+            if listed >= LISTING_PAGE_LIMIT:
                 break
+        else:
+            # End of the target, start over in the next pass
+            marker = ''
+        self.listing_markers[target] = marker
+
+    def _refill_evicted(self, downloader):
+        free_bytes = self.cache_max_size - self.cache.cache_size_bytes
+        for object_path, (get_hits, size) in self.cache.evicted_hot():
+            if self._overloaded():
+                break
+            victim = self.cache.peek_victim()
+            if size < free_bytes:
+                free_bytes -= size
+            elif not victim or get_hits <= victim.get_hits:
+                # Not worth more than what it would evict
+                continue
+            self.logger.info('Prefetch Filter - Refilling evicted object ' + object_path)
+            downloader.submit(object_path, get_hits)
+
+    def warm_up(self):
+        """
+        Fills the cache with the hottest objects of a proxy access log or
+        of a cache snapshot exported by another node, within the cache
+        size.
+        """
+        planner = WarmupPlanner()
+        if self.warmup_log:
+            planner.add_access_log(self.warmup_log)
+        if self.warmup_snapshot:
+            planner.add_snapshot(self.warmup_snapshot)
+        prefetch_list = planner.select(self.cache_max_size)
+        self.logger.info('Prefetch Filter - Warming up the cache with ' + str(len(prefetch_list)) + ' objects')
+
+        downloader = self._create_downloader(USER_AGENT)
+        for object_path in prefetch_list:
+            downloader.submit(object_path)
+        downloader.wait()
+
+    def _create_downloader(self, u_agent):
+        if self.download_client is None:
+            # The downloader retries the whole object, not only the request
+            self.download_client = InternalClient(PROXY_PATH, u_agent, request_tries=1)
+        swift = self.download_client
+        return PrefetchDownloader(self.logger, lambda object_path, throttle, get_hits=0:
+                                  self._prefetch_object(swift, object_path, throttle=throttle, get_hits=get_hits),
+                                  self.prefetch_concurrency, self.prefetch_retries,
+                                  self.prefetch_bandwidth, self.prefetch_iops)
+
+    def export_snapshots(self):
+        while True:
+            time.sleep(SNAPSHOT_EXPORT_INTERVAL)
+            try:
+                self.export_snapshot(self.snapshot_export_path)
+            except (IOError, OSError) as e:
+                self.logger.error('Prefetch Filter - Unable to export the cache snapshot: ' + str(e))
+
+    def export_snapshot(self, snapshot_path):
+        with self.cache.semaphore:
+            descriptors = self.cache.descriptors
+        tmp_path = snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            for descriptor in descriptors:
+                if descriptor.path:
+                    snapshot.write(json.dumps({'path': descriptor.path, 'size': descriptor.size,
+                                               'get_hits': descriptor.get_hits,
+                                               'last_access': descriptor.last_access}) + '\n')
+        os.rename(tmp_path, snapshot_path)
+
+    def _prefetch_object(self, swift, object_path, headers=None, throttle=None, max_size=None, get_hits=0):
+        """
+        Fetches an object into the cache. throttle(bytes) is called before
+        writing every chunk, and get_hits are the hits an evicted object
+        being refilled had. Returns the object size.
+        """
+        _, _, acc, container, name = object_path.split('/', 4)
+        oid = hashlib.md5(object_path).hexdigest()
+
+        start = time.time()
+        status, resp_headers, it = swift.get_object(acc, container, name, headers or {}, ACCEPTABLE_STATUS)
+
+        object_size = int(resp_headers.get('Content-Length'))
+        object_etag = resp_headers.get('Etag')
+        object_content_type = resp_headers.get('Content-Type')
+        object_storage_policy_id = resp_headers.get('X-Backend-Storage-Policy-Index', '0')
+        if object_size >= min(max_size or self.cache_max_size, self.cache_max_size):
+            if hasattr(it, 'close'):
+                it.close()
+            raise Exception('Object too large to be prefetched: ' + str(object_size) + ' bytes')
+
+        # The object only becomes visible in the cache once completely written
+        tmp_path = os.path.join(self.cache_path, oid + '.' + uuid.uuid4().hex + '.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                for el in it:
+                    if throttle:
+                        throttle(len(el))
+                    f.write(el)
+            if os.path.getsize(tmp_path) != object_size:
+                raise Exception('Truncated body, ' + str(os.path.getsize(tmp_path)) + ' bytes received')
+            os.rename(tmp_path, os.path.join(self.cache_path, oid))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
-        for name in prefetch_list:
-            object_path = '/v1/' + acc + '/' + container + '/' + name
-            oid = hashlib.md5(object_path).hexdigest()
+        target = self._get_target(object_path)
+        priority = target.priority if target else DEFAULT_TARGET_PRIORITY
+        to_evict = self.cache.access_cache("PUT", oid, object_size, object_etag, object_storage_policy_id,
+                                           object_path, get_hits, priority, object_content_type)
+        for ev_object_id in to_evict:
+            os.remove(os.path.join(self.cache_path, ev_object_id))
+        self.logger.info('Prefetch Filter - Object ' + name + ' stored in cache with ID: ' + oid)
 
-            status, resp_headers, it = swift.get_object(acc, container, name, headers, ACCEPTABLE_STATUS)
+        self.logger.increment('prefetch_fills_total')
+        self.logger.update_stats('prefetch_fill_bytes_total', object_size)
+        self.logger.update_stats('prefetch_evictions_total', len(to_evict))
+        self.logger.timing_since('prefetch_fill_latency', start)
+        return object_size
 
-            object_size = int(resp_headers.get('Content-Length'))
-            object_etag = resp_headers.get('Etag')
 
-            object_storage_policy_id = '0'  # FIXME hardcoded
-            to_evict = self.cache.access_cache("PUT", oid, object_size, object_etag, object_storage_policy_id)
-            for ev_object_id in to_evict:
-                os.remove(os.path.join(self.cache_path, ev_object_id))
+class PrefetchTarget(object):
+    """
+    Objects of a container, optionally under a prefix, kept prefetched
+    within a byte budget. Objects of lower priority targets are evicted
+    first.
+    """
 
-            self.logger.info('Prefetch Filter - Object ' + name + ' stored in cache with ID: ' + oid)
-            with open(os.path.join(self.cache_path, oid), 'w') as f:
-                for el in it:
-                    f.write(el)
+    def __init__(self, account, container, prefix, budget, priority):
+        self.account = account
+        self.container = container
+        self.prefix = prefix
+        self.budget = budget
+        self.priority = priority
+        self.path = '/v1/' + account + '/' + container + '/' + prefix
+
+    def matches(self, object_path):
+        return object_path.startswith(self.path)
+
+
+class LoadMeter(object):
+    """
+    Exponentially weighted rate of events per second, averaged over
+    LOAD_WINDOW seconds.
+    """
+
+    def __init__(self, window=LOAD_WINDOW):
+        self.window = float(window)
+        self.value = 0.0
+        self.last_update = time.time()
+
+    def _decay(self):
+        now = time.time()
+        self.value *= math.exp(-(now - self.last_update) / self.window)
+        self.last_update = now
+
+    def hit(self):
+        self._decay()
+        self.value += 1 / self.window
+
+    @property
+    def rate(self):
+        self._decay()
+        return self.value
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by the prefetch greenthreads, with up to one second
+    of burst. Callers exceeding the rate sleep until their debt is paid.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last_refill = time.time()
+
+    def acquire(self, amount=1):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            sleep(-self.tokens / self.rate)
+
+
+class PrefetchDownloader(object):
+    """
+    Fetches objects into the cache with a bounded pool of greenthreads.
+    Failed objects are retried with exponential backoff, and the bandwidth
+    and request rate can be capped with RateLimiters, shared by all the
+    downloaders so that prefetching does not starve foreground traffic.
+    Progress is logged periodically.
+    """
+
+    def __init__(self, logger, fetch, concurrency=DEFAULT_PREFETCH_CONCURRENCY,
+                 retries=DEFAULT_PREFETCH_RETRIES, bandwidth=None, iops=None):
+        self.logger = logger
+        # fetch(object_path, throttle) caches an object and returns its size
+        self.fetch = fetch
+        self.retries = retries
+        self.pool = GreenPool(concurrency)
+        # Bytes and requests per second, None for no limit
+        self.bandwidth = bandwidth
+        self.iops = iops
+
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.bytes_done = 0
+        self.last_report = time.time()
+
+    def submit(self, object_path, *args):
+        # args are passed on to fetch
+        self.submitted += 1
+        self.pool.spawn_n(self._download, object_path, *args)
+
+    def try_submit(self, object_path, *args):
+        """
+        Like submit, but returns False instead of waiting for a free
+        greenthread.
+        """
+        if not self.pool.free():
+            return False
+        self.submit(object_path, *args)
+        return True
+
+    def wait(self):
+        self.pool.waitall()
+        self._report()
+
+    @property
+    def pending(self):
+        return self.submitted - self.done - self.failed
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            self.bandwidth.acquire(size)
+
+    def _download(self, object_path, *args):
+        for attempt in range(self.retries + 1):
+            if self.iops:
+                self.iops.acquire()
+            try:
+                self.bytes_done += self.fetch(object_path, self._throttle, *args)
+                self.done += 1
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    self.failed += 1
+                    self.logger.warning('Prefetch Filter - Unable to prefetch object ' + object_path + ': ' + str(e))
+                else:
+                    sleep(PREFETCH_RETRY_BACKOFF * 2 ** attempt)
+
+        if time.time() - self.last_report >= PREFETCH_PROGRESS_INTERVAL:
+            self._report()
+
+    def _report(self):
+        self.last_report = time.time()
+        self.logger.info('Prefetch Filter - Prefetched ' + str(self.done) + '/' + str(self.submitted) +
+                         ' objects (' + str(round(self.bytes_done / MB, 2)) + ' MB), ' +
+                         str(self.failed) + ' failed, ' + str(self.pending) + ' pending')
+
+
+class AccessPredictor(object):
+    """
+    Learns the access patterns of the intercepted GETs of each container
+    and predicts the next objects to be read, with a confidence:
+    - Sequential object names (part-00000, part-00001...): the confidence
+      grows with the length of the sequential run.
+    - Transitions between objects, kept in a bounded Markov table: the
+      confidence is the frequency of the transition.
+    - Bursts of accesses under the same prefix: the whole prefix is
+      predicted.
+    """
+
+    def __init__(self):
+        # container path -> (last object name, sequential run length)
+        self.streams = OrderedDict()
+        # object path -> {next object path: count}
+        self.transitions = OrderedDict()
+        # (container path, prefix) -> [burst start, accesses, predicted]
+        self.bursts = OrderedDict()
+        self.lock = Lock()
+
+    def record(self, object_path):
+        """
+        Learns from an access and returns the predictions it triggers, as
+        ('object', object path, confidence) or
+        ('prefix', (container path, prefix), confidence) tuples.
+        """
+        parts = object_path.split('/', 4)
+        if len(parts) < 5 or not parts[4]:
+            return []
+        container_path, name = '/'.join(parts[:4]), parts[4]
+
+        predictions = []
+        with self.lock:
+            last_name, run = self.streams.pop(container_path, (None, 0))
+            if last_name is not None:
+                self._learn_transition(container_path + '/' + last_name, object_path)
+                run = run + 1 if self._next_name(last_name, 1) == name else 0
+            self._bounded_set(self.streams, container_path, (name, run))
+
+            if run:
+                confidence = run / (run + 1.0)
+                for step in range(1, SEQUENTIAL_LOOKAHEAD + 1):
+                    predictions.append(('object', container_path + '/' + self._next_name(name, step), confidence))
+            predictions.extend(self._predict_transitions(object_path))
+            burst = self._record_burst(container_path, name)
+            if burst:
+                predictions.append(burst)
+        return predictions
+
+    def _next_name(self, name, step):
+        match = SEQUENTIAL_NAME.match(name)
+        if not match:
+            return None
+        prefix, number, suffix = match.groups()
+        # Keep the zero padding
+        return prefix + str(int(number) + step).zfill(len(number)) + suffix
+
+    def _learn_transition(self, previous_path, object_path):
+        if previous_path == object_path:
+            return
+        counts = self.transitions.pop(previous_path, {})
+        counts[object_path] = counts.get(object_path, 0) + 1
+        if len(counts) > MAX_STATE_TRANSITIONS:
+            del counts[min(counts, key=counts.get)]
+        self._bounded_set(self.transitions, previous_path, counts)
+
+    def _predict_transitions(self, object_path):
+        counts = self.transitions.get(object_path)
+        if not counts:
+            return []
+        total = float(sum(counts.values()))
+        if total < MIN_TRANSITION_OBSERVATIONS:
+            return []
+        return [('object', next_path, count / total) for next_path, count in counts.items()]
+
+    def _record_burst(self, container_path, name):
+        key = (container_path, name[:name.rfind('/') + 1])
+        if not key[1]:
+            # Objects not under a pseudo-directory would list the whole container
+            return None
+        now = time.time()
+        burst = self.bursts.pop(key, None)
+        if burst is None or now - burst[0] > PREFIX_BURST_WINDOW:
+            burst = [now, 0, False]
+        burst[1] += 1
+        self._bounded_set(self.bursts, key, burst)
+        if burst[1] >= PREFIX_BURST_ACCESSES and not burst[2]:
+            # Predicted once per window
+            burst[2] = True
+            return 'prefix', key, 1 - 1.0 / burst[1]
+        return None
+
+    def _bounded_set(self, table, key, value):
+        # Tables are kept in LRU order
+        table[key] = value
+        if len(table) > MAX_PREDICTOR_STATES:
+            table.popitem(last=False)
+
+
+class WarmupPlanner(object):
+    """
+    Ranks objects by frequency and recency of access, from Swift proxy
+    access logs or cache snapshots, to choose the objects to warm up. Each
+    access is weighted by its age, halving every WARMUP_HALF_LIFE seconds.
+    """
+
+    def __init__(self, half_life=WARMUP_HALF_LIFE):
+        self.half_life = half_life
+        self.now = time.time()
+        # object path -> [score, size]
+        self.candidates = {}
+
+    def _add(self, object_path, size, accesses, last_access):
+        weight = accesses * 0.5 ** (max(self.now - last_access, 0) / self.half_life)
+        candidate = self.candidates.setdefault(object_path, [0.0, size])
+        candidate[0] += weight
+        candidate[1] = size
+
+    def add_access_log(self, log_path):
+        with open(log_path, 'r') as access_log:
+            for line in access_log:
+                access = self._parse_access_log_line(line)
+                if access:
+                    self._add(access[0], access[1], 1, access[2])
+
+    def _parse_access_log_line(self, line):
+        # [syslog header] proxy-server: client_ip remote_addr datetime method path protocol
+        # status referer user_agent auth_token bytes_recvd bytes_sent client_etag
+        # transaction_id headers request_time source log_info start_time ...
+        if 'proxy-server:' not in line:
+            return None
+        fields = line.split('proxy-server:', 1)[1].split()
+        if len(fields) < 19 or fields[3] != 'GET' or fields[6] != '200' or fields[16] != '-':
+            return None
+        if urllib.unquote(fields[8]) == USER_AGENT or not fields[11].isdigit():
+            # Prefetches are not accesses
+            return None
+        object_path = urllib.unquote(fields[4]).split('?')[0]
+        if not object_path.startswith('/v1/') or len(object_path.split('/', 4)) < 5 or \
+                not object_path.split('/', 4)[4]:
+            return None
+        try:
+            start_time = float(fields[18])
+        except ValueError:
+            return None
+        return object_path, int(fields[11]), start_time
+
+    def add_snapshot(self, snapshot_path):
+        with open(snapshot_path, 'r') as snapshot:
+            for line in snapshot:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._add(str(record['path']), record['size'], record['get_hits'] + 1, record['last_access'])
+
+    def select(self, budget):
+        """
+        Returns the paths of the hottest objects fitting in budget bytes.
+        """
+        selected = []
+        ranking = sorted(self.candidates.items(), key=lambda candidate: candidate[1][0], reverse=True)
+        for object_path, (_, size) in ranking:
+            if size < budget:
+                selected.append(object_path)
+                budget -= size
+        return selected
 
 
 class CacheObjectDescriptor(object):
 
-    def __init__(self, block_id, size, etag, storage_policy_id):
+    def __init__(self, block_id, size, etag, storage_policy_id, path=None, content_type=None):
         self.block_id = block_id
         self.last_access = time.time()
         self.get_hits = 0
@@ -174,6 +948,9 @@ class CacheObjectDescriptor(object):
         self.size = size
         self.etag = etag
         self.storage_policy_id = storage_policy_id
+        self.path = path
+        self.content_type = content_type
+        self.priority = DEFAULT_TARGET_PRIORITY
 
     def get_hit(self):
         self.get_hits += 1
@@ -188,13 +965,158 @@ class CacheObjectDescriptor(object):
         self.num_accesses += 1
 
 
+class LRUEvictionPolicy(object):
+    """
+    Least Recently Used order kept in a linked hash map: descriptors are moved
+    to the tail on every access, so the head is always the next victim.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for block_id in reversed(self.entries):
+            yield self.entries[block_id]
+
+    def add(self, descriptor):
+        self.entries[descriptor.block_id] = descriptor
+
+    def touch(self, descriptor):
+        del self.entries[descriptor.block_id]
+        self.entries[descriptor.block_id] = descriptor
+
+    def remove(self, descriptor):
+        del self.entries[descriptor.block_id]
+
+    def peek_victim(self):
+        return self.entries[next(iter(self.entries))]
+
+    def pop_victim(self):
+        return self.entries.popitem(last=False)[1]
+
+
+class LFUEvictionPolicy(object):
+    """
+    Least Frequently Used order kept in frequency buckets: one linked hash map
+    per number of GET hits, plus the lowest non-empty frequency. Ties inside a
+    bucket are evicted in LRU order.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.frequencies = {}
+        self.min_frequency = 0
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for frequency in sorted(self.buckets, reverse=True):
+            bucket = self.buckets[frequency]
+            for block_id in reversed(bucket):
+                yield bucket[block_id]
+
+    def add(self, descriptor):
+        frequency = descriptor.get_hits
+        if not self.frequencies or frequency < self.min_frequency:
+            self.min_frequency = frequency
+        self.buckets.setdefault(frequency, OrderedDict())[descriptor.block_id] = descriptor
+        self.frequencies[descriptor.block_id] = frequency
+
+    def touch(self, descriptor):
+        old_frequency = self.frequencies[descriptor.block_id]
+        if old_frequency == descriptor.get_hits:
+            # PUT hits do not change the LFU order
+            return
+        self._unlink(descriptor.block_id, old_frequency)
+        if old_frequency == self.min_frequency and old_frequency not in self.buckets:
+            self.min_frequency = descriptor.get_hits
+        self.buckets.setdefault(descriptor.get_hits, OrderedDict())[descriptor.block_id] = descriptor
+        self.frequencies[descriptor.block_id] = descriptor.get_hits
+
+    def remove(self, descriptor):
+        self._unlink(descriptor.block_id, self.frequencies.pop(descriptor.block_id))
+
+    def peek_victim(self):
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = min(self.buckets)
+        bucket = self.buckets[self.min_frequency]
+        return bucket[next(iter(bucket))]
+
+    def pop_victim(self):
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = min(self.buckets)
+        bucket = self.buckets[self.min_frequency]
+        _, descriptor = bucket.popitem(last=False)
+        if not bucket:
+            del self.buckets[self.min_frequency]
+        del self.frequencies[descriptor.block_id]
+        return descriptor
+
+    def _unlink(self, block_id, frequency):
+        bucket = self.buckets[frequency]
+        del bucket[block_id]
+        if not bucket:
+            del self.buckets[frequency]
+
+
+eviction_policies = {"LRU": LRUEvictionPolicy, "LFU": LFUEvictionPolicy}
+
+
+class PriorityEviction(object):
+    """
+    One eviction structure per priority: victims are taken from the lowest
+    priority, in the order of the eviction policy within it.
+    """
+
+    def __init__(self, structure_class):
+        self.structure_class = structure_class
+        self.structures = {}
+
+    def __len__(self):
+        return sum(len(structure) for structure in self.structures.values())
+
+    def __iter__(self):
+        # From the most valuable descriptor to the next one to be evicted
+        for priority in sorted(self.structures, reverse=True):
+            for descriptor in self.structures[priority]:
+                yield descriptor
+
+    def add(self, descriptor):
+        if descriptor.priority not in self.structures:
+            self.structures[descriptor.priority] = self.structure_class()
+        self.structures[descriptor.priority].add(descriptor)
+
+    def touch(self, descriptor):
+        self.structures[descriptor.priority].touch(descriptor)
+
+    def remove(self, descriptor):
+        structure = self.structures[descriptor.priority]
+        structure.remove(descriptor)
+        if not len(structure):
+            del self.structures[descriptor.priority]
+
+    def peek_victim(self):
+        return self.structures[min(self.structures)].peek_victim()
+
+    def pop_victim(self):
+        priority = min(self.structures)
+        descriptor = self.structures[priority].pop_victim()
+        if not len(self.structures[priority]):
+            del self.structures[priority]
+        return descriptor
+
+
 class BlockCache(object):
 
     def __init__(self, cache_max_size, eviction_policy):
         # This will contain the actual data of each block
         self.descriptors_dict = {}
-        # Structure to store the cache metadata of each block
-        self.descriptors = []
         # Cache statistics
         self.get_hits = 0
         self.put_hits = 0
@@ -204,60 +1126,105 @@ class BlockCache(object):
         self.writes = 0
         self.cache_size_bytes = 0
         self.cache_max_size = cache_max_size
+        # Seconds spent waiting for the cache lock
+        self.lock_wait = 0.0
+        # Evicted objects that had hits: path -> (get_hits, size)
+        self.evicted = OrderedDict()
 
         # Eviction policy
         self.policy = eviction_policy
+        # Structure keeping the cache metadata of each block in eviction order
+        self.eviction = self._create_eviction_structure(eviction_policy)
         # Synchronize shared cache content
         self.semaphore = Semaphore()
 
-    def access_cache(self, operation='PUT', block_id=None, block_data=None, etag=None, storage_policy_id=None):
+    def access_cache(self, operation='PUT', block_id=None, block_data=None, etag=None, storage_policy_id=None,
+                     path=None, get_hits=0, priority=DEFAULT_TARGET_PRIORITY, content_type=None):
         result = None
         if ENABLE_CACHE:
+            start = time.time()
             self.semaphore.acquire()
-            if operation == 'PUT':
-                result = self._put(block_id, block_data, etag, storage_policy_id)
-            elif operation == 'GET':
-                result = self._get(block_id)
-            else:
-                raise Exception("Unsupported cache operation" + operation)
-            # Sort descriptors based on eviction policy order
-            self._sort_descriptors()
-            self.semaphore.release()
+            self.lock_wait += time.time() - start
+            try:
+                if operation == 'PUT':
+                    result = self._put(block_id, block_data, etag, storage_policy_id, path, get_hits, priority,
+                                       content_type)
+                elif operation == 'GET':
+                    result = self._get(block_id)
+                else:
+                    raise Exception("Unsupported cache operation" + operation)
+            finally:
+                self.semaphore.release()
         return result
 
-    def _put(self, block_id, block_size, etag, storage_policy_id):
+    def is_object_in_cache(self, block_id):
+        return block_id in self.descriptors_dict
+
+    def get_descriptor(self, block_id):
+        return self.descriptors_dict.get(block_id)
+
+    def peek_victim(self):
+        with self.semaphore:
+            if not self.descriptors_dict:
+                return None
+            return self.eviction.peek_victim()
+
+    def evicted_hot(self):
+        """
+        Evicted objects with hits, from the most to the least hit.
+        """
+        with self.semaphore:
+            evicted = list(self.evicted.items())
+        return sorted(evicted, key=lambda entry: entry[1][0], reverse=True)
+
+    def _put(self, block_id, block_size, etag, storage_policy_id, path=None, get_hits=0,
+             priority=DEFAULT_TARGET_PRIORITY, content_type=None):
         self.writes += 1
         to_evict = []
-        # Check if the cache is full and if the element is new
-        if self.cache_max_size <= (self.cache_size_bytes + block_size) and block_id not in self.descriptors_dict:
-            # Evict as many files as necessary until having enough space for new one
-            while self.cache_max_size <= (self.cache_size_bytes + block_size):
-                # Get the last element ordered by the eviction policy
-                self.descriptors, evicted = self.descriptors[:-1], self.descriptors[-1]
-                # Reduce the size of the cache
-                self.cache_size_bytes -= evicted.size
-                # Increase evictions count and add to
-                self.evictions += 1
-                to_evict.append(evicted.block_id)
-                # Remove from evictions dict
-                del self.descriptors_dict[evicted.block_id]
-
-        if block_id in self.descriptors_dict:
-            descriptor = self.descriptors_dict[block_id]
-            self.descriptors_dict[block_id].size = block_size
-            self.descriptors_dict[block_id].etag = etag
-            self.descriptors_dict[block_id].storage_policy_id = storage_policy_id
+        descriptor = self.descriptors_dict.get(block_id)
+        if descriptor:
+            # A resized element makes room like a new one, without being a victim itself
+            self.eviction.remove(descriptor)
+            self.cache_size_bytes -= descriptor.size
+
+        # Evict as many files as necessary until having enough space for the element
+        while self.cache_max_size <= (self.cache_size_bytes + block_size) and len(self.eviction):
+            # Get the next victim according to the eviction policy
+            evicted = self.eviction.pop_victim()
+            # Reduce the size of the cache
+            self.cache_size_bytes -= evicted.size
+            # Increase evictions count and add to
+            self.evictions += 1
+            to_evict.append(evicted.block_id)
+            # Remove from evictions dict
+            del self.descriptors_dict[evicted.block_id]
+            if evicted.path and evicted.get_hits:
+                self.evicted[evicted.path] = (evicted.get_hits, evicted.size)
+                if len(self.evicted) > MAX_EVICTED_HISTORY:
+                    self.evicted.popitem(last=False)
+
+        if descriptor:
+            self.cache_size_bytes += block_size
+            descriptor.size = block_size
+            descriptor.etag = etag
+            descriptor.storage_policy_id = storage_policy_id
+            descriptor.content_type = content_type
+            descriptor.priority = priority
             descriptor.put_hit()
+            self.eviction.add(descriptor)
             self.put_hits += 1
         else:
             # Add the new element to the cache
-            descriptor = CacheObjectDescriptor(block_id, block_size, etag, storage_policy_id)
-            self.descriptors.append(descriptor)
+            descriptor = CacheObjectDescriptor(block_id, block_size, etag, storage_policy_id, path, content_type)
+            # Refilled objects keep the hits they had when evicted
+            descriptor.get_hits = get_hits
+            descriptor.priority = priority
+            self.evicted.pop(path, None)
+            self.eviction.add(descriptor)
             self.descriptors_dict[block_id] = descriptor
             self.cache_size_bytes += block_size
 
-        assert len(self.descriptors) == len(self.descriptors_dict.keys()) ==\
-            len(self.descriptors_dict.keys()), "Unequal length in cache data structures"
+        assert len(self.eviction) == len(self.descriptors_dict), "Unequal length in cache data structures"
 
         return to_evict
 
@@ -265,19 +1232,21 @@ class BlockCache(object):
         self.reads += 1
         if block_id in self.descriptors_dict:
             self.descriptors_dict[block_id].get_hit()
+            self.eviction.touch(self.descriptors_dict[block_id])
             self.get_hits += 1
             return block_id, self.descriptors_dict[block_id].size, self.descriptors_dict[block_id].etag, self.descriptors_dict[block_id].storage_policy_id
         self.misses += 1
         return None, 0, '', ''
 
-    def _sort_descriptors(self):
-        # Order the descriptor list depending on the policy
-        if self.policy == "LRU":
-            self.descriptors.sort(key=lambda desc: desc.last_access, reverse=True)
-        elif self.policy == "LFU":
-            self.descriptors.sort(key=lambda desc: desc.get_hits, reverse=True)
-        else:
+    @property
+    def descriptors(self):
+        # Descriptors ordered from the most valuable to the next victim
+        return list(self.eviction)
+
+    def _create_eviction_structure(self, policy):
+        if policy not in eviction_policies:
             raise Exception("Unsupported caching policy.")
+        return PriorityEviction(eviction_policies[policy])
 
     def write_statistics(self):
         if ENABLE_CACHE:
@@ -291,6 +1260,8 @@ class BlockCache(object):
         print "CACHE READS: ", self.reads
         print "CACHE WRITES: ", self.writes
         print "CACHE SIZE: ", self.cache_size_bytes
+        print "CACHE MAX SIZE: ", self.cache_max_size
+        print "CACHE LOCK WAIT: ", self.lock_wait
 
         for descriptor in self.descriptors:
             print "Object: ", descriptor.block_id, descriptor.last_access, descriptor.get_hits, descriptor.put_hits, descriptor.num_accesses, descriptor.size